@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+#
+# Download many manuscripts from several libraries in one run.
+#
+# Jobs are read from a file (or stdin), one per line, library first:
+#
+#   # comments and empty lines are skipped
+#   bl add_ms_24686 --resolution 13 --pages 0:10
+#   bl arundel_ms_263
+#   nb URN:NBN:no-nb_digibok_2008091504048 book.pdf --scale 0.5
+#
+# All jobs share one HTTP session, one rate governor per host and one tile
+# budget, and up to --jobs of them run at the same time, so a slow
+# manuscript does not hold up the rest of the queue. Jobs of the same
+# manuscript run one after another.
+#
+#   $ python3 batch.py jobs.txt --jobs 4 --tile-workers 8
+#   $ cat jobs.txt | python3 batch.py -
+
+import argparse
+import json
+import logging
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from manuscript_dl import transport
+from manuscript_dl.cache import HttpCache
+from manuscript_dl.memory import MemoryBudget
+from manuscript_dl.metrics import metrics
+from manuscript_dl.pipeline import print_line
+from manuscript_dl.scripts import load_script
+
+LIBRARIES = ('bl', 'nb')
+
+
+class Job:
+    def __init__(self, number, library, id, options):
+        self.number = number
+        self.library = library
+        self.id = id
+        self.options = options
+        self.status = 'queued'
+        self.pages = None
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def describe(self):
+        line = 'job {} {} {}: {}'.format(self.number, self.library, self.id,
+                                        self.status)
+        if self.started is not None:
+            line += ' in {:.1f}s'.format(self.elapsed())
+        if self.pages is not None:
+            line += ', {} pages'.format(self.pages)
+        if self.error:
+            line += ', {}'.format(self.error)
+        return line
+
+    def as_dict(self):
+        return {'job': self.number, 'library': self.library, 'id': self.id,
+                'status': self.status, 'pages': self.pages,
+                'elapsed': round(self.elapsed(), 3), 'error': self.error}
+
+
+def job_parser(library):
+    parser = argparse.ArgumentParser(prog=library, add_help=False)
+    if library == 'bl':
+        parser.add_argument('--resolution', type=int, default=12)
+        parser.add_argument('--pages', default=':')
+        parser.add_argument('--embed-jpeg', action='store_true')
+    else:
+        parser.add_argument('filename', nargs='?', default=None)
+        parser.add_argument('--scale', type=float, default=0.5)
+        parser.add_argument('--no-ocr', action='store_true',
+                            help='Write the PDF in-process, without OCR')
+    return parser
+
+
+def read_jobs(lines):
+    '''
+    Parse job list. Errors are reported with the line number, before any
+    job starts.
+    '''
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        words = shlex.split(line, comments=True)
+        if not words:
+            continue
+        if words[0] not in LIBRARIES or len(words) < 2:
+            raise ValueError('line {}: expected "{} ID [options]"'.format(
+                number, '|'.join(LIBRARIES)))
+        try:
+            options = job_parser(words[0]).parse_args(words[2:])
+        except SystemExit:
+            raise ValueError('line {}: bad options {}'.format(
+                number, ' '.join(words[2:])))
+        jobs.append(Job(len(jobs) + 1, words[0], words[1], options))
+    return jobs
+
+
+class Batch:
+    def __init__(self, jobs, args):
+        self.jobs = jobs
+        self.args = args
+        self.lock = threading.Lock()
+        self.executor = None
+        # Jobs waiting for an earlier job of the same manuscript to finish,
+        # they share its journal and output files
+        self.waiting = {}
+        self.memory = MemoryBudget(args.memory_budget * 1024 * 1024)
+        self.cache = None
+        if any(job.library == 'nb' for job in jobs):
+            self.cache = HttpCache(args.cache_dir,
+                                   args.cache_size * 1024 * 1024)
+
+    def report(self, job):
+        with self.lock:
+            print_line('[batch] ' + job.describe())
+            if self.args.status:
+                with open(self.args.status, 'w') as f:
+                    json.dump([job.as_dict() for job in self.jobs], f,
+                              indent=4)
+
+    def progress(self, job, line):
+        print_line(line)
+
+    def get_pages(self, bl, manuscript):
+        return bl.get_pages(manuscript)
+
+    def get_manifest(self, nb, id, downloader):
+        return nb.get_manifest(id, downloader)
+
+    def run_bl(self, job):
+        bl = load_script('bl.uk.py')
+        args, options = self.args, job.options
+        workers = bl.Workers(args.tile_workers, args.page_workers,
+                             args.stitch_workers, args.encode_workers)
+        stages = bl.download_manuscript(
+            options.pages, options.resolution,
+            bl.level_dir(args.base_dir, options.resolution), job.id,
+            workers, options.embed_jpeg,
+            all_pages=self.get_pages(bl, job.id),
+            report=lambda line: self.progress(job, line))
+        job.pages = stages[0].count
+
+    def run_nb(self, job):
+        nb = load_script('nb.no.py')
+        args, options = self.args, job.options
+
+        def downloader(url):
+            return self.cache.get(url, transport.http_get_sync)
+
+        book = nb.Book(job.id, downloader, options.scale, args.page_workers,
+                       args.tile_workers,
+                       manifest=self.get_manifest(nb, job.id, downloader))
+        book.memory = self.memory
+        job.pages = len(book.pages())
+        done = []
+
+        def progress(page):
+            done.append(page)
+            self.progress(job, 'page {} ({}/{})'.format(page.id, len(done),
+                                                       job.pages))
+
+        book.progress = progress
+        book.download()
+        if options.no_ocr:
+            book.write_pdf(nb.suffix(options.filename or book.label, '.pdf'))
+        else:
+            book.convert(options.filename)
+
+    def run_job(self, job):
+        job.status, job.started = 'running', time.time()
+        self.report(job)
+        try:
+            if job.library == 'bl':
+                self.run_bl(job)
+            else:
+                self.run_nb(job)
+            job.status = 'done'
+        except Exception as e:
+            logging.exception('job %s failed', job.number)
+            job.status, job.error = 'failed', repr(e)
+        job.finished = time.time()
+        self.report(job)
+        metrics.count('batch.' + job.status, library=job.library, id=job.id)
+
+    def start(self, job):
+        '''
+        Run job, or queue it after the earlier jobs of the same manuscript.
+        '''
+        key = job.library, job.id
+        with self.lock:
+            if key in self.waiting:
+                self.waiting[key].append(job)
+                return
+            self.waiting[key] = []
+        self.executor.submit(self.run_in_turn, job)
+
+    def run_in_turn(self, job):
+        # Queued jobs of the manuscript run in the same thread, after it
+        key = job.library, job.id
+        while job is not None:
+            self.run_job(job)
+            with self.lock:
+                if self.waiting[key]:
+                    job = self.waiting[key].pop(0)
+                else:
+                    del self.waiting[key]
+                    job = None
+
+    def run(self):
+        with ThreadPoolExecutor(self.args.jobs) as self.executor:
+            for job in self.jobs:
+                self.start(job)
+        if self.cache is not None:
+            self.cache.close()
+
+
+def share_transport():
+    '''
+    Make bl.uk.py send its requests through the session and rate governor
+    used by the IIIF downloaders.
+    '''
+    bl = load_script('bl.uk.py')
+    transport._session.headers.update({'User-Agent': bl.USER_AGENT})
+    bl._session = transport._session
+    bl._governor = transport._governor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download many manuscripts')
+    parser.add_argument('job_list', metavar='jobs',
+                        help='Job list file, - for stdin')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='Number of jobs to run at the same time')
+    parser.add_argument('--base-dir', default='pics',
+                        help='Base directory of British Library manuscripts')
+    parser.add_argument('--tile-workers', type=int, default=8,
+                        help='Number of requests in flight per host, '
+                        'across all jobs')
+    parser.add_argument('--page-workers', type=int, default=2,
+                        help='Number of pages to download at the same time, per job')
+    parser.add_argument('--stitch-workers', type=int, default=2,
+                        help='Number of pages to stitch at the same time, per job')
+    parser.add_argument('--encode-workers', type=int, default=2,
+                        help='Number of pages to prepare for PDF at the same '
+                        'time, per job')
+    parser.add_argument('--memory-budget', type=int, default=1024,
+                        help='Memory for nb.no page images in flight, MiB, '
+                        'across all jobs')
+    parser.add_argument('--pool-hosts', type=int, default=4,
+                        help='Number of hosts to keep connection pools for')
+    parser.add_argument('--cache-dir', default=None,
+                        help='HTTP cache directory of nb.no jobs')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='Size limit of cached tiles, MiB')
+    parser.add_argument('--status', default=None,
+                        help='Keep status of all jobs in this JSON file')
+    parser.add_argument('--trace', default=None,
+                        help='Append every request and stage to this JSON-lines file')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    if args.job_list == '-':
+        jobs = read_jobs(sys.stdin)
+    else:
+        with open(args.job_list) as f:
+            jobs = read_jobs(f)
+
+    share_transport()
+    if any(job.library == 'nb' for job in jobs):
+        nb = load_script('nb.no.py')
+        if args.cache_dir is None:
+            args.cache_dir = nb.CACHE_DIR
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    # Requests in flight to a host are capped by the governor, so the pool
+    # does not need more connections than that
+    transport.configure_pool(args.pool_hosts, args.tile_workers,
+                             args.tile_workers)
+    if args.trace:
+        metrics.open_trace(args.trace)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    batch = Batch(jobs, args)
+    try:
+        batch.run()
+    finally:
+        metrics.close()
+
+    for line in metrics.summary():
+        print_line(line)
+    for job in jobs:
+        print_line(job.describe())
+    return 1 if any(job.status == 'failed' for job in jobs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
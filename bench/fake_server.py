@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in for the British Library Proxy and IIIF image servers, serving
+synthetic tiles, so that the downloaders can be measured without touching
+the real libraries.
+
+British Library:
+    /manuscripts/Viewer.aspx?ref={manuscript}
+    /manuscripts/Proxy.ashx?view={page}.xml
+    /manuscripts/Proxy.ashx?view={page}_files/{resolution}/{column}_{row}.jpg
+IIIF:
+    /iiif/{book}/manifest
+    /iiif/image/{id}/info.json
+    /iiif/image/{id}/{x},{y},{w},{h}/{w},/0/default.jpg
+    /iiif/image/{id}/full/{size}/0/default.jpg
+Counters:
+    /stats
+
+    python3 bench/fake_server.py --port 8000 --latency 0.05 --throttle 0.01
+'''
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+INVALID_BLOCK = b'Parameter is not valid.'
+
+
+@lru_cache(maxsize=64)
+def synthetic_jpeg(width, height):
+    '''
+    JPEG with some texture, so that it compresses about as well as a scan.
+    Tiles of the same size are the same, the server only encodes each once.
+    '''
+    noise = Image.effect_noise((width, height), 40).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    data = BytesIO()
+    Image.blend(noise, gradient, 0.5).save(data, 'JPEG', quality=85)
+    return data.getvalue()
+
+
+class Settings:
+    def __init__(self, pages=4, width=4000, height=3000, tile_size=256,
+                 latency=0.0, throttle=0.0, retry_after=1, descriptor=True):
+        self.pages = pages
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.descriptor = descriptor
+        self.max_level = int(math.ceil(math.log(max(width, height), 2)))
+        self.stats = {'requests': 0, 'tiles': 0, 'bytes': 0, 'throttled': 0}
+        self.lock = threading.Lock()
+
+    def count(self, **kwargs):
+        with self.lock:
+            for key, value in kwargs.items():
+                self.stats[key] += value
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    settings = Settings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type='image/jpeg', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.settings.count(bytes=len(body))
+
+    def do_GET(self):
+        settings = self.settings
+        url = urlsplit(self.path)
+        if url.path == '/stats':
+            with settings.lock:
+                body = json.dumps(settings.stats).encode()
+            return self.reply(200, body, 'application/json')
+
+        settings.count(requests=1)
+        if settings.latency:
+            time.sleep(settings.latency)
+        if settings.throttle and random.random() < settings.throttle:
+            settings.count(throttled=1)
+            return self.reply(429, b'Too Many Requests', 'text/plain',
+                              {'Retry-After': str(settings.retry_after)})
+
+        if url.path == '/manuscripts/Viewer.aspx':
+            return self.viewer(parse_qs(url.query)['ref'][0])
+        if url.path == '/manuscripts/Proxy.ashx':
+            return self.proxy(parse_qs(url.query)['view'][0])
+        match = re.match(r'^/iiif/([^/]+)/manifest$', url.path)
+        if match:
+            return self.manifest(match.group(1))
+        match = re.match(r'^/iiif/image/([^/]+)/(.+)$', url.path)
+        if match:
+            return self.image(match.group(1), match.group(2))
+        self.reply(404, b'Not found', 'text/plain')
+
+    def viewer(self, manuscript):
+        pages = ''.join('||{}_f{:03d}r'.format(manuscript, i)
+                        for i in range(self.settings.pages))
+        html = ('<html><body><input type="hidden" name="PageList" '
+                'id="PageList" value="##{}"/></body></html>').format(pages)
+        self.reply(200, html.encode(), 'text/html')
+
+    def level_size(self, resolution):
+        scale = 2 ** (self.settings.max_level - resolution)
+        return (int(math.ceil(self.settings.width / float(scale))),
+                int(math.ceil(self.settings.height / float(scale))))
+
+    def proxy(self, view):
+        settings = self.settings
+        if view.endswith('.xml'):
+            if not settings.descriptor:
+                return self.reply(404, b'Not found', 'text/plain')
+            xml = ('<?xml version="1.0" encoding="utf-8"?>'
+                   '<Image TileSize="{}" Overlap="0" Format="jpg" '
+                   'xmlns="http://schemas.microsoft.com/deepzoom/2008">'
+                   '<Size Width="{}" Height="{}"/></Image>').format(
+                       settings.tile_size, settings.width, settings.height)
+            return self.reply(200, xml.encode(), 'text/xml')
+
+        match = re.match(r'^.+_files/(\d+)/(\d+)_(\d+)\.jpg$', view)
+        if not match:
+            return self.reply(500, INVALID_BLOCK, 'text/plain')
+        resolution, column, row = map(int, match.groups())
+        width, height = self.level_size(resolution)
+        x, y = column * settings.tile_size, row * settings.tile_size
+        if x >= width or y >= height:
+            return self.reply(500, INVALID_BLOCK, 'text/plain')
+        settings.count(tiles=1)
+        self.reply(200, synthetic_jpeg(min(settings.tile_size, width - x),
+                                       min(settings.tile_size, height - y)))
+
+    def manifest(self, book):
+        settings = self.settings
+        base = 'http://{}/iiif/image'.format(self.headers['Host'])
+        canvases = [{
+            'width': settings.width, 'height': settings.height,
+            'images': [{'resource': {
+                '@id': '{}/{}_{:04d}/full/full/0/default.jpg'.format(
+                    base, book, i),
+                'service': {'@id': '{}/{}_{:04d}'.format(base, book, i),
+                            'width': settings.width,
+                            'height': settings.height}}}]}
+            for i in range(settings.pages)]
+        manifest = {'label': 'Benchmark {}'.format(book),
+                    'sequences': [{'canvases': canvases}]}
+        self.reply(200, json.dumps(manifest).encode(), 'application/json')
+
+    def image(self, id, request):
+        settings = self.settings
+        if request == 'info.json':
+            info = {'@id': id, 'width': settings.width,
+                    'height': settings.height,
+                    'tiles': [{'width': 1024,
+                               'scaleFactors': [1, 2, 4, 8, 16]}]}
+            return self.reply(200, json.dumps(info).encode(),
+                              'application/json')
+
+        match = re.match(r'^(\d+),(\d+),(\d+),(\d+)/(\d+),/0/default\.jpg$',
+                         request)
+        if match:
+            x, y, w, h, size = map(int, match.groups())
+            w = min(w, settings.width - x)
+            h = min(h, settings.height - y)
+            if w <= 0 or h <= 0:
+                return self.reply(400, b'Bad region', 'text/plain')
+            settings.count(tiles=1)
+            return self.reply(200, synthetic_jpeg(size, max(1, round(h * size / w))))
+
+        match = re.match(r'^full/(full|max|pct:([\d.]+))/0/default\.jpg$',
+                         request)
+        if match:
+            scale = float(match.group(2) or 100) / 100
+            settings.count(tiles=1)
+            return self.reply(200, synthetic_jpeg(
+                max(1, round(settings.width * scale)),
+                max(1, round(settings.height * scale))))
+        self.reply(400, b'Bad request', 'text/plain')
+
+
+def serve(port, settings):
+    Handler.settings = settings
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake BL Proxy and IIIF server')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pages', type=int, default=4,
+                        help='Number of pages of every manuscript or book')
+    parser.add_argument('--width', type=int, default=4000,
+                        help='Full size page width, pixels')
+    parser.add_argument('--height', type=int, default=3000,
+                        help='Full size page height, pixels')
+    parser.add_argument('--tile-size', type=int, default=256,
+                        help='Deep zoom tile size')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Delay before every reply, seconds')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='Share of requests answered with HTTP 429')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After of throttled replies, seconds')
+    parser.add_argument('--no-descriptor', action='store_true',
+                        help='Do not serve Deep Zoom descriptors')
+    args = parser.parse_args()
+    serve(args.port, Settings(args.pages, args.width, args.height,
+                              args.tile_size, args.latency, args.throttle,
+                              args.retry_after, not args.no_descriptor))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+'''
+Offline benchmark of the downloaders. Starts bench/fake_server.py in its own
+process and runs bl.uk.py download_manuscript and nb.no.py Book.download
+against it, each in a fresh process and a fresh directory, and reports
+tiles/s, bytes/s, peak RSS and time of every pipeline stage.
+
+    python3 bench/run.py --pages 8 --latency 0.02 --tile-workers 8
+'''
+
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from os.path import abspath, dirname
+from urllib.request import urlopen
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, dirname(abspath(__file__)))
+
+import fake_server  # noqa: E402
+from manuscript_dl.scripts import load_script  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, settings):
+    server = multiprocessing.Process(target=fake_server.serve,
+                                     args=(port, settings), daemon=True)
+    server.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Fake server did not start')
+
+
+def server_stats(base):
+    with urlopen(base + '/stats') as reply:
+        return json.loads(reply.read())
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_bl(base, args, workdir):
+    bl = load_script('bl.uk.py')
+    bl.URL_PAGES = base + '/manuscripts/Viewer.aspx?ref={manuscript}'
+    bl.URL_PAGE_DESCRIPTOR = (base + '/manuscripts/Proxy.ashx?'
+                              'view={manuscript_and_page}.xml')
+    bl.URL_IMAGE_BLOCK = (base + '/manuscripts/Proxy.ashx?view='
+                          '{manuscript_and_page}_files/{resolution}/'
+                          '{column}_{row}.jpg')
+    bl._governor.maximum = args.tile_workers
+    bl._session.mount('http://', bl.requests.adapters.HTTPAdapter(
+        pool_maxsize=max(args.tile_workers, 10)))
+
+    workers = bl.Workers(args.tile_workers, args.page_workers,
+                         args.stitch_workers, args.encode_workers)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        stages = bl.download_manuscript(
+            ':', args.resolution, bl.level_dir(workdir, args.resolution),
+            'bench_ms', workers, args.embed_jpeg)
+    return [stage.summary() for stage in stages]
+
+
+def bench_nb(base, args, workdir):
+    nb = load_script('nb.no.py')
+    logging.getLogger().setLevel(logging.WARNING)
+    from manuscript_dl.transport import configure_pool, http_get_sync
+    nb.URL_MANIFEST = base + '/iiif/{}/manifest'
+    configure_pool(1, args.tile_workers, args.tile_workers)
+
+    os.chdir(workdir)
+    started = time.time()
+    book = nb.Book('bench_book', http_get_sync, args.scale, args.page_workers,
+                   args.tile_workers)
+    book.download()
+    downloaded = time.time()
+    book.write_pdf('bench_book.pdf')
+    finished = time.time()
+    return ['download: {:.2f}s'.format(downloaded - started),
+            'pdf: {:.2f}s'.format(finished - downloaded)]
+
+
+def run_child(function, base, args, results):
+    workdir = tempfile.mkdtemp(prefix='manuscript-dl-bench-')
+    started = time.time()
+    try:
+        stages = function(base, args, workdir)
+    except Exception:
+        # Parent waits for a result, it must get one
+        results.put({'error': traceback.format_exc()})
+        return
+    elapsed = time.time() - started
+    from manuscript_dl.metrics import metrics
+    results.put({'elapsed': elapsed, 'stages': stages + metrics.summary(),
+                 'peak_rss': peak_rss()})
+
+
+def run(name, function, base, args):
+    before = server_stats(base)
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_child,
+                                    args=(function, base, args, results))
+    child.start()
+    result = results.get()
+    child.join()
+    after = server_stats(base)
+    if 'error' in result:
+        print('{}: failed\n{}'.format(name, result['error']))
+        return
+
+    tiles = after['tiles'] - before['tiles']
+    size = after['bytes'] - before['bytes']
+    elapsed = result['elapsed']
+    print('{}: {:.2f}s, {} tiles ({:.1f} tiles/s), {:.1f} MB ({:.2f} MB/s), '
+          '{} requests, {} throttled, peak RSS {:.1f} MB'.format(
+              name, elapsed, tiles, tiles / elapsed, size / 1e6,
+              size / 1e6 / elapsed, after['requests'] - before['requests'],
+              after['throttled'] - before['throttled'],
+              result['peak_rss'] / 1e6))
+    for stage in result['stages']:
+        print('    ' + stage)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline downloader benchmark')
+    parser.add_argument('--only', choices=['bl', 'nb'], default=None,
+                        help='Run only one of the benchmarks')
+    parser.add_argument('--pages', type=int, default=4)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Server delay before every reply, seconds')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='Share of requests answered with HTTP 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--no-descriptor', action='store_true',
+                        help='Make bl.uk.py search for the grid')
+    parser.add_argument('--resolution', type=int, default=12)
+    parser.add_argument('--scale', type=float, default=0.5)
+    parser.add_argument('--tile-workers', type=int, default=8)
+    parser.add_argument('--page-workers', type=int, default=2)
+    parser.add_argument('--stitch-workers', type=int, default=2)
+    parser.add_argument('--encode-workers', type=int, default=2)
+    parser.add_argument('--embed-jpeg', action='store_true')
+    args = parser.parse_args()
+
+    port = free_port()
+    settings = fake_server.Settings(args.pages, args.width, args.height,
+                                    args.tile_size, args.latency,
+                                    args.throttle, args.retry_after,
+                                    not args.no_descriptor)
+    server = start_server(port, settings)
+    base = 'http://127.0.0.1:{}'.format(port)
+    try:
+        if args.only in (None, 'bl'):
+            run('bl.uk.py download_manuscript', bench_bl, base, args)
+        if args.only in (None, 'nb'):
+            run('nb.no.py Book.download', bench_nb, base, args)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
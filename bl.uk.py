@@ -26,33 +26,62 @@ from __future__ import print_function
 
 import os
 import re
+import json
 import sys
 import time
-import glob
+import math
 import urllib
-import shutil
-import imghdr
 import argparse
 import random
+import threading
+import multiprocessing
 
 from os.path import join as J
-from subprocess import call
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from xml.etree import ElementTree
 
 import requests
 from bs4 import BeautifulSoup
+from PIL import Image
+
+from manuscript_dl.dzi import DziWriter
+from manuscript_dl.iiif import spit_bytes
+from manuscript_dl.journal import Journal
+from manuscript_dl.metrics import metrics
+from manuscript_dl.pdf import PdfUpdater, PdfWriter, encode_image, read_jpeg
+from manuscript_dl.pipeline import Stage, print_line, run_pipeline
+from manuscript_dl.ratelimit import THROTTLE_STATUSES, RateGovernor
+from manuscript_dl.tilestore import TileStore
+from manuscript_dl.workqueue import WorkQueue, run_worker
 
 
 # col 22
 # row 32
 
 URL_PAGES = "http://www.bl.uk/manuscripts/Viewer.aspx?ref={manuscript}"
+URL_PAGE_DESCRIPTOR = "http://www.bl.uk/manuscripts/Proxy.ashx?view={manuscript_and_page}.xml"
 URL_IMAGE_BLOCK = "http://www.bl.uk/manuscripts/Proxy.ashx?view={manuscript_and_page}_files/{resolution}/{column}_{row}.jpg"
 INVALID_BLOCK_MAGIC_SUBSTRING = b'Parameter is not valid'
 MAX_BLOCK_DOWNLOAD_RETRIES = 6
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+# Fully decode every block before it is saved, catches corrupt scan data that
+# marker checks miss, at the cost of CPU
+DECODE_BLOCKS = False
+PAGE_JPEG_QUALITY = 90
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/65.0.3325.181 Safari/537.36'
 
 
+# Number of workers of every stage of the download
+Workers = namedtuple('Workers', ['tiles', 'pages', 'stitch', 'encode'])
+
 _session = requests.Session()
+_governor = RateGovernor()
+# Out of range block of every resolution, the same for all pages
+_nil_blocks = {}
+_nil_blocks_lock = threading.Lock()
 
 
 def download(save_folder):
@@ -99,6 +128,13 @@ def download(save_folder):
     print("Download finished!")
 
 
+def http_get(url):
+    '''
+    GET url through the shared session, within the rate limit of the host.
+    '''
+    return _governor.get(_session, url)
+
+
 def mkpath(path):
     '''
     Make dir if it does not yet exist.
@@ -110,16 +146,11 @@ def mkpath(path):
             pass
 
 
-def put(string):
-    sys.stdout.write(string)
-    sys.stdout.flush()
-
-
 def get_pages(manuscript):
     '''
     Download manuscript page and extract the number of pages it contains.
     '''
-    reply = _session.get(URL_PAGES.format(manuscript=manuscript))
+    reply = http_get(URL_PAGES.format(manuscript=manuscript))
     soup = BeautifulSoup(reply.text, 'html.parser')
     str_pages = soup.find('input', {'id': 'PageList'}).attrs['value']
     pages = str_pages.replace('##', '').split('||')
@@ -141,22 +172,39 @@ def is_valid_block(current_block, nil_block):
     return True
 
 
+def is_valid_jpeg(data, decode=False):
+    '''
+    Valid JPEG starts with SOI and ends with EOI marker, so a truncated
+    download does not pass. Some encoders pad the file after EOI. If decode
+    is set, the image is also decoded.
+    '''
+    if not data.startswith(JPEG_SOI):
+        return False
+    if not data.rstrip(b'\0').endswith(JPEG_EOI):
+        return False
+    if decode:
+        try:
+            with Image.open(BytesIO(data)) as image:
+                image.load()
+        except (OSError, SyntaxError, ValueError):
+            return False
+    return True
+
+
 def is_valid_image(filename):
     '''
-    Valid image is an image that can be parsed as a JPEG file.
+    Valid image is a file that passes is_valid_jpeg.
     '''
     if not os.path.exists(filename):
         return False
 
-    return imghdr.what(filename) == 'jpeg'
+    with open(filename, 'rb') as f:
+        return is_valid_jpeg(f.read())
 
 
 class BlockResult(Exception):
     pass
 
-class BlockAlreadyDownloaded(BlockResult):
-    pass
-
 class BlockInvalid(BlockResult):
     pass
 
@@ -164,28 +212,29 @@ class BlockMaxRetriesReached(BlockResult):
     pass
 
 
-def download_block(url, filename, nil_block):
+def download_block(url, store, nil_block):
     '''
     Download single page block (rectangular). This method will retry up to
     MAX_BLOCK_DOWNLOAD_RETRIES times if downloaded image is not JPEG.
     Delays between retries are choosen according to the binary exponential
-    backoff strategy.
+    backoff strategy. The block is checked in memory and only a valid one is
+    put into the tile store. Return its hash. A block that is still throttled
+    raises BlockMaxRetriesReached, never BlockInvalid.
     '''
     for i in range(MAX_BLOCK_DOWNLOAD_RETRIES):
-        # Do not download twice
-        if is_valid_image(filename):
-            raise BlockAlreadyDownloaded()
-
-        block = _session.get(url)
+        block = http_get(url)
+        # The governor has already waited and retried, a block that is still
+        # throttled is not known to be out of range
+        if block.status_code in THROTTLE_STATUSES:
+            metrics.count('block.throttled', url=url)
+            raise BlockMaxRetriesReached()
         if not is_valid_block(block, nil_block):
+            metrics.count('block.invalid', url=url)
             raise BlockInvalid()
 
-        # Note that I save in row-column order
-        with open(filename, 'wb') as output_file:
-            output_file.write(block.content)
-
         # Retry if not a valid image
-        if not is_valid_image(filename):
+        if not is_valid_jpeg(block.content, DECODE_BLOCKS):
+            metrics.count('block.retry', url=url)
             # Skip sleeping if this is the last attempt
             if i != MAX_BLOCK_DOWNLOAD_RETRIES - 1:
                 sleep_duration = random.randint(1, 2**i)
@@ -194,178 +243,583 @@ def download_block(url, filename, nil_block):
                 time.sleep(sleep_duration)
             continue
 
-        return None
+        return store.put(block.content)
 
     # print('Failed to download page block %s after %s retries' % \
     #       (url, MAX_BLOCK_DOWNLOAD_RETRIES))
+    metrics.count('block.max_retries', url=url)
     raise BlockMaxRetriesReached()
 
 
-def download_page(resolution, base_dir, manuscript, page):
+def read_grid_descriptor(resolution, page):
+    '''
+    Read Deep Zoom descriptor of the page and compute number of columns and
+    rows at given resolution level. Return None if the Proxy does not serve
+    the descriptor.
+    '''
+    reply = http_get(URL_PAGE_DESCRIPTOR.format(manuscript_and_page=page))
+    if reply.status_code != 200:
+        return None
+    try:
+        image = ElementTree.fromstring(reply.content)
+        size = next(e for e in image if e.tag.endswith('Size'))
+        tile_size = int(image.attrib['TileSize'])
+        width = int(size.attrib['Width'])
+        height = int(size.attrib['Height'])
+    except (ElementTree.ParseError, StopIteration, KeyError, ValueError):
+        return None
+
+    # Deep zoom pyramid halves the image at each level, the top level is the
+    # one where the image is shown in full size
+    max_level = int(math.ceil(math.log(max(width, height), 2)))
+    scale = 2 ** (max_level - resolution)
+    width = int(math.ceil(width / float(scale)))
+    height = int(math.ceil(height / float(scale)))
+    columns = int(math.ceil(width / float(tile_size)))
+    rows = int(math.ceil(height / float(tile_size)))
+    return columns, rows
+
+
+def search_extent(is_valid):
     '''
-    Download single page into base_dir/manuscript/page directory.
-    There will be a bunch of block files that you will need to concatenate
-    later.
+    Find the first index for which is_valid returns False, assuming that valid
+    indices form a prefix. Exponential search finds the bounds, binary search
+    narrows them down.
     '''
-    mkpath(J(base_dir, manuscript, page))
+    if not is_valid(0):
+        return 0
+
+    low, high = 0, 1
+    while is_valid(high):
+        low, high = high, high * 2
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if is_valid(middle):
+            low = middle
+        else:
+            high = middle
+    return high
+
 
-    # First download image block that is out of range to see how such image
-    # looks like (this is used to detect edges later)
-    nil_block = _session.get(URL_IMAGE_BLOCK.format(manuscript_and_page=page,
-                                                    resolution=resolution,
-                                                    column=999, row=999))
+def block_filename(base_dir, manuscript, page, row, column):
+    # Note that I save in row-column order
+    return J(base_dir, manuscript, page,
+             '{0}_{1}_{2}.jpg'.format(page, row, column))
 
-    column, row = 0, 0
-    max_column, max_row = 0, 0
 
-    while True:
-        filename = J(base_dir, manuscript, page,
-                     '{0}_{1}_{2}.jpg'.format(page, row, column))
+def block_key(page, row, column):
+    return '{0}/{1}_{2}'.format(page, row, column)
 
-        #print('Getting block {0}x{1}'.format(row, column))
+
+def tile_store(base_dir):
+    '''
+    Blocks of all manuscripts and resolutions are kept in one store, next to
+    the resolution directories. The journal of a manuscript maps every block
+    to its hash.
+    '''
+    return TileStore(J(os.path.dirname(base_dir), 'tiles'))
+
+
+def block_path(base_dir, manuscript, page, row, column, journal):
+    '''
+    File of a block recorded in the journal. Blocks downloaded before the
+    tile store was introduced are recorded without hash and stay where they
+    were.
+    '''
+    hash = journal.get('block', block_key(page, row, column))
+    if hash:
+        return tile_store(base_dir).path(hash)
+    return block_filename(base_dir, manuscript, page, row, column)
+
+
+def get_nil_block(resolution, page):
+    '''
+    Download image block that is out of range to see how such image looks
+    like (this is used to detect edges later). It is the same for all pages
+    of a resolution, so it is only downloaded once. A response that is still
+    throttled is not kept, the next page asks again.
+    '''
+    with _nil_blocks_lock:
+        if resolution in _nil_blocks:
+            return _nil_blocks[resolution]
+        nil_block = http_get(URL_IMAGE_BLOCK.format(
+            manuscript_and_page=page, resolution=resolution,
+            column=999, row=999))
+        if nil_block.status_code not in THROTTLE_STATUSES:
+            _nil_blocks[resolution] = nil_block
+        return nil_block
+
+
+def open_journal(base_dir, manuscript, shared=False):
+    '''
+    Open journal of finished work of the manuscript. If the journal is new
+    (missing or corrupt), files already on disk are recorded in it first.
+    Set shared if worker processes use it at the same time.
+    '''
+    mkpath(J(base_dir, manuscript))
+    journal = Journal(J(base_dir, manuscript, 'journal.sqlite'), shared)
+    if not journal.imported:
+        import_journal(journal, base_dir, manuscript)
+    return journal
+
+
+def import_journal(journal, base_dir, manuscript):
+    '''
+    Record valid blocks and pages found in manuscript directory.
+    '''
+    block_name = re.compile(r'^(.+)_(\d+)_(\d+)\.jpg$')
+    for entry in os.scandir(J(base_dir, manuscript)):
+        if entry.is_dir():
+            page = entry.name
+            for block in os.scandir(entry.path):
+                match = block_name.match(block.name)
+                if (match and match.group(1) == page and
+                        is_valid_image(block.path)):
+                    row, column = int(match.group(2)), int(match.group(3))
+                    journal.add('block', block_key(page, row, column))
+        elif entry.name.endswith('.jpg') and is_valid_image(entry.path):
+            journal.add('page', entry.name[:-len('.jpg')])
+    journal.mark_imported()
+
+
+def discover_grid(resolution, base_dir, manuscript, page, nil_block, journal):
+    '''
+    Find out number of columns and rows of the page. Deep Zoom descriptor is
+    used if available, otherwise row 0 and column 0 are searched for their
+    last valid block. Blocks downloaded during search are kept. Return the
+    grid and whether it is certain: a block that could not be downloaded
+    (e.g. still throttled) counts as valid, so the search goes on, but the
+    grid may be wrong and should not be recorded.
+    '''
+    grid = read_grid_descriptor(resolution, page)
+    if grid is not None:
+        return grid + (True,)
+    unsure = []
+
+    def is_valid(row, column):
+        if journal.has('block', block_key(page, row, column)):
+            return True
         url = URL_IMAGE_BLOCK.format(manuscript_and_page=page,
                                      resolution=resolution,
                                      column=column, row=row)
-
         try:
-            download_block(url, filename, nil_block)
-        except BlockAlreadyDownloaded:
-            max_row = max(row, max_row)
-            max_column = max(column, max_column)
-            column += 1
-            put('.')
-            continue
+            hash = download_block(url, tile_store(base_dir), nil_block)
         except BlockInvalid:
-            put('\n')
-            # We are out of range
-            if column == 0:
-                # The end of the page
-                print('End of the page')
-                print('Page {0} has size row x column = {1} x {2}'.format(
-                    page, max_row, max_column))
-                break
-            else:
-                # The end of the row, reset column, increment row
-                column = 0
-                row += 1
-                continue
+            return False
         except BlockMaxRetriesReached:
-            put('X')
+            unsure.append((row, column))
         else:
-            put('.')
+            journal.add('block', block_key(page, row, column), hash)
+        return True
 
-        # Update page size
-        max_row = max(row, max_row)
-        max_column = max(column, max_column)
+    columns = search_extent(lambda column: is_valid(0, column))
+    if columns == 0:
+        return 0, 0, not unsure
+    rows = search_extent(lambda row: is_valid(row, 0))
+    return columns, rows, not unsure
 
-        # Go to next column
-        column += 1
-
-    return max_column, max_row
 
+def download_page(resolution, base_dir, manuscript, page, journal,
+                  tile_workers=1, report=print_line):
+    '''
+    Download blocks of a single page into the tile store, the journal maps
+    them to their hashes. They will need to be concatenated later. Up to
+    tile_workers blocks are requested at the same time. Blocks recorded in
+    the journal are not downloaded again. Progress, a line of . (done) and X
+    (failed) per row, goes to report.
+    '''
+    nil_block = get_nil_block(resolution, page)
+
+    grid = journal.get('grid', page)
+    if grid is not None:
+        columns, rows = map(int, grid.split(','))
+    else:
+        columns, rows, certain = discover_grid(
+            resolution, base_dir, manuscript, page, nil_block, journal)
+        if certain:
+            journal.add('grid', page, '{0},{1}'.format(columns, rows))
+    max_column, max_row = columns - 1, rows - 1
+    report('Page {0} has size row x column = {1} x {2}'.format(
+        page, max_row, max_column))
+
+    def fetch(position):
+        row, column = position
+        if journal.has('block', block_key(page, row, column)):
+            return '.'
+        url = URL_IMAGE_BLOCK.format(manuscript_and_page=page,
+                                     resolution=resolution,
+                                     column=column, row=row)
+        try:
+            hash = download_block(url, tile_store(base_dir), nil_block)
+        except (BlockInvalid, BlockMaxRetriesReached):
+            return 'X'
+        journal.add('block', block_key(page, row, column), hash)
+        return '.'
+
+    positions = [(row, column)
+                 for row in range(rows) for column in range(columns)]
+    line = ''
+    with ThreadPoolExecutor(max_workers=tile_workers) as executor:
+        for (row, column), result in zip(positions,
+                                         executor.map(fetch, positions)):
+            line += result
+            if column == max_column:
+                report(line)
+                line = ''
 
-def atoi(text):
-    return int(text) if text.isdigit() else text
+    return max_column, max_row
 
 
-def natural_keys(text):
+def block_sizes(paths):
     '''
-    Taken from:
-    http://stackoverflow.com/a/5967539/258421
-
-    alist.sort(key=natural_keys) sorts in human order
-    http://nedbatchelder.com/blog/200712/human_sorting.html
-    (See Toothy's implementation in the comments)
+    Sizes of blocks at the given positions. Only headers are read, one file
+    at a time, and every distinct block once.
     '''
-    return [atoi(c) for c in re.split('(\d+)', text)]
+    sizes = {}
+    for path in set(paths.values()):
+        with Image.open(path) as block:
+            sizes[path] = block.size
+    return dict((position, sizes[path]) for position, path in paths.items())
 
 
-def concatenate_page(base_dir, manuscript, page, columns, rows):
+def grid_sizes(sizes, columns, rows):
     '''
-    Concatenate image blocks into a single page (still jpg).
+    Widths of columns and heights of rows of blocks of the given sizes.
+    Missing blocks are left blank, size of their row and column is taken from
+    the rest of the blocks.
     '''
-    # How concat blocks into row looks in shell:
-    # montage -mode concatenate -tile x1 `ls -1cr add_ms_24686_f044r_5_*` row_0.jpg
-    for row in range(rows + 1):
-        row_filename = J(base_dir, manuscript, page, 'row_{0}.jpg'.format(row))
-        if os.path.exists(row_filename):
-            continue
+    widths = [max([sizes[r, c][0] for r in range(rows + 1)
+                   if (r, c) in sizes] or [0])
+              for c in range(columns + 1)]
+    heights = [max([sizes[r, c][1] for c in range(columns + 1)
+                    if (r, c) in sizes] or [0])
+               for r in range(rows + 1)]
+    return widths, heights
 
-        glob_name = '{0}_{1}_*.jpg'.format(
-            J(base_dir, manuscript, page, page), row)
-        row_blocks = sorted(glob.glob(glob_name), key=natural_keys)
-        cmd = ('montage -mode concatenate -tile x1'.split() +
-               row_blocks + [row_filename])
-        call(cmd)
-        put('.')
 
-    # How concat rows into page looks in shell:
-    # montage -mode concatenate -tile 1x `ls -1cr row_*` add_ms_24686_f044r.jpg
-    page_filename = J(base_dir, manuscript, page) + '.jpg'
-    if os.path.exists(page_filename):
+def concatenate_page(base_dir, manuscript, page, columns, rows, journal,
+                     report=print_line):
+    '''
+    Concatenate image blocks into a single page (still jpg). Blocks are pasted
+    straight into the page canvas, row by row. Each distinct block is decoded
+    once, even if it appears in several places (blank margins), and no more
+    than one block file is open at a time. A page without any block is
+    reported and left out of the journal, the next run downloads it again.
+    '''
+    if journal.has('page', page):
         return
+    started, cpu_started = time.time(), time.thread_time()
+    page_filename = J(base_dir, manuscript, page) + '.jpg'
 
-    glob_name = '{0}_*.jpg'.format(J(base_dir, manuscript, page, 'row'))
-    rows = sorted(glob.glob(glob_name), key=natural_keys)
-    cmd = ('montage -mode concatenate -tile 1x'.split() +
-           rows + [page_filename])
-    call(cmd)
-    put('\n')
-
-
-def convert_pages(base_dir, manuscript, pages):
+    paths = {}
+    for row in range(rows + 1):
+        for column in range(columns + 1):
+            if journal.has('block', block_key(page, row, column)):
+                paths[row, column] = block_path(base_dir, manuscript, page,
+                                                row, column, journal)
+    if not paths:
+        report('Page {0} has no blocks, skipped'.format(page))
+        return
+    uses = Counter(paths.values())
+    widths, heights = grid_sizes(block_sizes(paths), columns, rows)
+
+    canvas = Image.new('RGB', (sum(widths), sum(heights)))
+    # Blocks are decoded as they are pasted, which also closes their files.
+    # Only blocks that appear again further down are kept decoded
+    decoded = {}
+    y = 0
+    for row in range(rows + 1):
+        x = 0
+        for column in range(columns + 1):
+            path = paths.get((row, column))
+            if path is not None:
+                block = decoded.pop(path, None)
+                if block is None:
+                    block = Image.open(path)
+                    block.load()
+                canvas.paste(block, (x, y))
+                uses[path] -= 1
+                if uses[path]:
+                    decoded[path] = block
+                else:
+                    block.close()
+            x += widths[column]
+        y += heights[row]
+
+    canvas.save(page_filename, 'JPEG', quality=PAGE_JPEG_QUALITY)
+    metrics.observe('stitch', time.time() - started,
+                    cpu=time.thread_time() - cpu_started, page=page)
+    journal.add('page', page)
+
+
+def write_dzi_page(base_dir, manuscript, page, columns, rows, journal):
     '''
-    Convert manuscript images into PDFs and join into single PDF.
+    Write blocks of the page into a Deep Zoom image (dzi/page.dzi and
+    dzi/page_files), block JPEGs are copied as they are. Lower levels are
+    built from every four tiles as soon as they are in place, so there is
+    never more than a few tiles in memory, whatever the size of the page.
     '''
-    for i, page in enumerate(pages):
-        input_name = J(base_dir, manuscript, '{0}.jpg'.format(page))
-        output_name = J(base_dir, manuscript, '{0}.pdf'.format(page))
-        if os.path.exists(output_name):
-            continue
-        print('Converting page {0} ({1}/{2})'.format(page, i + 1, len(pages)))
-        cmd = ['convert', input_name, output_name]
-        call(cmd)
+    if journal.has('dzi', page):
+        return
+    started, cpu_started = time.time(), time.thread_time()
+    paths = {}
+    for row in range(rows + 1):
+        for column in range(columns + 1):
+            if journal.has('block', block_key(page, row, column)):
+                paths[row, column] = block_path(base_dir, manuscript, page,
+                                                row, column, journal)
+    widths, heights = grid_sizes(block_sizes(paths), columns, rows)
+    # Blocks are the same size except in the last row and column
+    tile_size = max(widths[:-1] + heights[:-1] or widths + heights)
+
+    writer = DziWriter(J(base_dir, manuscript, 'dzi'), page,
+                       sum(widths), sum(heights), tile_size)
+    for row in range(rows + 1):
+        for column in range(columns + 1):
+            if (row, column) in paths:
+                with open(paths[row, column], 'rb') as f:
+                    writer.put_tile(column, row, f.read())
+    writer.close()
+    metrics.observe('dzi', time.time() - started,
+                    cpu=time.thread_time() - cpu_started, page=page)
+    journal.add('dzi', page)
 
 
-def fold_pages(base_dir, manuscript, pages, output_name):
+def level_dir(base_dir, resolution):
     '''
-    Fold pdf pages into one by applying concat operation to a pair of docs.
+    Every resolution level is kept in its own tree.
     '''
-    tmp_name = J(base_dir, manuscript + '.pdf.tmp')
-    pdfs = ['{0}.pdf'.format(page) for page in pages]
-    for i, pdf in enumerate(pdfs):
-        print('Folding page {0} ({1}/{2})'.format(pdf, i + 1, len(pages)))
-        pdf_name = J(base_dir, manuscript, pdf)
-        if os.path.exists(output_name):
-            cmd = ['pdftk', output_name, pdf_name, 'cat', 'output', tmp_name]
-            call(cmd)
-            os.unlink(output_name)
-            os.rename(tmp_name, output_name)
-        else:
-            shutil.copy2(pdf_name, output_name)
+    return J(base_dir, str(resolution))
 
 
-def download_pages(resolution, base_dir, manuscript, pages):
+def derive_page(source_dir, base_dir, manuscript, page, levels, source_journal,
+                journal):
     '''
-    Download all pages of the manuscript.
+    Build blocks and page of a lower resolution level from the stitched page
+    of a higher one. Deep zoom pyramid halves the image at every level, so
+    the page is reduced by 2**levels and cut into blocks of the same size.
     '''
-    # Download pages
-    for i, page in enumerate(pages):
-        print('Downloading page {0} ({1}/{2})'.format(page, i + 1, len(pages)))
-        columns, rows = download_page(resolution, base_dir, manuscript, page)
+    source = Image.open(J(source_dir, manuscript, '{0}.jpg'.format(page)))
+
+    # Block size is the size of the first block along a side that has more
+    # than one block. With a single source block, a single block is enough.
+    tile_size = None
+    grid = source_journal.get('grid', page)
+    if grid is not None:
+        columns, rows = map(int, grid.split(','))
+        with Image.open(block_path(source_dir, manuscript, page, 0, 0,
+                                   source_journal)) as block:
+            if columns > 1:
+                tile_size = block.size[0]
+            elif rows > 1:
+                tile_size = block.size[1]
+
+    image = source.reduce(2 ** levels)
+    source.close()
+    width, height = image.size
+    tile_size = tile_size or max(width, height)
+    columns = int(math.ceil(width / float(tile_size)))
+    rows = int(math.ceil(height / float(tile_size)))
+    store = tile_store(base_dir)
+    for row in range(rows):
+        for column in range(columns):
+            x, y = column * tile_size, row * tile_size
+            block = image.crop((x, y, min(x + tile_size, width),
+                                min(y + tile_size, height)))
+            data = BytesIO()
+            block.save(data, 'JPEG', quality=PAGE_JPEG_QUALITY)
+            journal.add('block', block_key(page, row, column),
+                        store.put(data.getvalue()))
+    journal.add('grid', page, '{0},{1}'.format(columns, rows))
+
+    image.save(J(base_dir, manuscript, '{0}.jpg'.format(page)), 'JPEG',
+               quality=PAGE_JPEG_QUALITY)
+    journal.add('page', page)
+
+
+def derive_pages(source_resolution, resolution, base_dir, manuscript, pages,
+                 journal, workers):
+    '''
+    Derive pages at resolution from pages downloaded at a higher
+    source_resolution. Pages that are not downloaded at source resolution are
+    left for the download.
+    '''
+    source_dir = level_dir(os.path.dirname(base_dir), source_resolution)
+    source_journal = open_journal(source_dir, manuscript)
+
+    def derive(page):
+        if journal.has('page', page):
+            return
+        if not source_journal.has('page', page):
+            print('Page {0} is not downloaded at resolution {1}'.format(
+                page, source_resolution))
+            return
+        with metrics.timed('derive', page=page):
+            derive_page(source_dir, base_dir, manuscript, page,
+                        source_resolution - resolution, source_journal,
+                        journal)
+        print('Derived page {0} from resolution {1}'.format(
+            page, source_resolution))
+
+    with ThreadPoolExecutor(max_workers=workers.stitch) as executor:
+        list(executor.map(derive, pages))
+    source_journal.close()
+
+
+def pdf_filename(resolution, base_dir, manuscript, pages):
+    suffix = '-p{0}-r{1}.pdf'.format(len(pages), resolution)
+    return J(base_dir, manuscript + suffix)
 
-        print('Concatenating page {0} ({1}/{2})'.format(page, i + 1, len(pages)))
-        concatenate_page(base_dir, manuscript, page, columns, rows)
 
+def append_pages(stages, resolution, base_dir, manuscript, pages, journal,
+                 workers, embed_jpeg, order, report=print_line):
+    '''
+    Run pages through stages and add the ones that are not in the PDF of the
+    resolution yet with an incremental update: bytes already in the PDF are
+    never rewritten. Pages are kept in the order of the manuscript.
+    '''
+    output_name = J(base_dir, '{0}-r{1}.pdf'.format(manuscript, resolution))
+    state = json.loads(journal.get('pdf-append', output_name, 'null'))
+    if (state is None or not os.path.exists(output_name) or
+            os.path.getsize(output_name) < state['length']):
+        state = {'pages': [], 'kids': [], 'length': 0}
+    kids = dict(zip(state['pages'], state['kids']))
+    if all(page in kids for page in pages):
+        report('{0} is up to date'.format(output_name))
+        run_pipeline(stages, pages, report=report)
+        return
 
-def convert_manuscript(resolution, base_dir, manuscript, pages):
+    encode_image_or_jpeg = read_jpeg if embed_jpeg else encode_image
+
+    def encode(page_filename):
+        if page_filename is None:
+            return None
+        page = os.path.basename(page_filename)[:-len('.jpg')]
+        if page in kids:
+            return None
+        return page, encode_image_or_jpeg(page_filename)
+
+    def write(encoded):
+        if encoded is not None:
+            page, image = encoded
+            kids[page] = writer.add_page(*image)
+
+    if state['length']:
+        writer = PdfUpdater(output_name, state['kids'], state['length'])
+    else:
+        writer = PdfWriter(output_name)
+    with writer:
+        stages += [Stage('encode', encode, workers.encode),
+                   Stage('write', write, ordered=True)]
+        run_pipeline(stages, pages, report=report)
+        position = dict((page, i) for i, page in enumerate(order))
+        written = sorted(kids, key=lambda page: position.get(page, len(order)))
+        writer.pages = [kids[page] for page in written]
+    journal.add('pdf-append', output_name, json.dumps({
+        'pages': written, 'kids': [kids[page] for page in written],
+        'length': os.path.getsize(output_name)}))
+
+
+def process_pages(resolution, base_dir, manuscript, pages, journal, workers,
+                  embed_jpeg=False, pyramid=0, order=None, dzi=False,
+                  report=print_line):
     '''
-    Convert manuscript and fold its pages into a single PDF.
+    Download pages, stitch them and write them into a single PDF. Stages run
+    in a pipeline, each with its own workers: while one page is downloaded,
+    the previous one is stitched and the one before is written into the PDF.
+    Conversion is skipped if the same pages have already been written into
+    the same file. If pyramid is set, that many lower resolution levels are
+    derived from every stitched page. If order (all pages of the
+    manuscript) is set, new pages are appended to the PDF of the resolution
+    instead, see append_pages. If dzi is set, every page is written as a
+    Deep Zoom image instead of being stitched, and there is no PDF. Progress
+    lines of the stages go to report. Return the stages, they carry
+    throughput statistics.
     '''
-    convert_pages(base_dir, manuscript, pages)
-    suffix = '-p{0}-r{1}.pdf'.format(len(pages), resolution)
-    output_name = J(base_dir, manuscript + suffix)
-    fold_pages(base_dir, manuscript, pages, output_name)
+    output_name = pdf_filename(resolution, base_dir, manuscript, pages)
+    converted = ','.join(pages)
+    up_to_date = (journal.get('pdf', output_name) == converted and
+                  os.path.exists(output_name))
+
+    def download(page):
+        if journal.has('dzi' if dzi else 'page', page):
+            return page, None
+        return page, download_page(resolution, base_dir, manuscript, page,
+                                   journal, workers.tiles, report)
+
+    if dzi:
+        def write_dzi(downloaded):
+            page, grid = downloaded
+            if grid is not None:
+                columns, rows = grid
+                write_dzi_page(base_dir, manuscript, page, columns, rows,
+                               journal)
+
+        stages = [Stage('download', download, workers.pages),
+                  Stage('dzi', write_dzi, workers.stitch)]
+        run_pipeline(stages, pages, report=report)
+        return stages
+
+    lower_levels = [(levels, level_dir(os.path.dirname(base_dir),
+                                       resolution - levels))
+                    for levels in range(1, pyramid + 1)]
+    lower_journals = [open_journal(lower_dir, manuscript)
+                      for _, lower_dir in lower_levels]
+
+    missing = []
+
+    def stitch(downloaded):
+        page, grid = downloaded
+        if grid is not None:
+            columns, rows = grid
+            concatenate_page(base_dir, manuscript, page, columns, rows,
+                             journal, report)
+        if not journal.has('page', page):
+            # Nothing to encode, the page is left out
+            missing.append(page)
+            return None
+        for (levels, lower_dir), lower_journal in zip(lower_levels,
+                                                      lower_journals):
+            if not lower_journal.has('page', page):
+                with metrics.timed('derive', page=page):
+                    derive_page(base_dir, lower_dir, manuscript, page, levels,
+                                journal, lower_journal)
+        return J(base_dir, manuscript, '{0}.jpg'.format(page))
+
+    stages = [Stage('download', download, workers.pages),
+              Stage('stitch', stitch, workers.stitch)]
+    if order is not None:
+        append_pages(stages, resolution, base_dir, manuscript, pages, journal,
+                     workers, embed_jpeg, order, report)
+    elif up_to_date:
+        report('{0} is up to date'.format(output_name))
+        run_pipeline(stages, pages, report=report)
+    else:
+        encode_image_or_jpeg = read_jpeg if embed_jpeg else encode_image
+
+        def encode(page_filename):
+            if page_filename is not None:
+                return encode_image_or_jpeg(page_filename)
+
+        def write(image):
+            if image is not None:
+                writer.add_page(*image)
+
+        with PdfWriter(output_name) as writer:
+            stages += [Stage('encode', encode, workers.encode),
+                       Stage('write', write, ordered=True)]
+            run_pipeline(stages, pages, report=report)
+        if missing:
+            # Not recorded, so that the next run writes it again
+            report('Written {0} without {1} pages, run again to complete it'
+                   .format(output_name, len(missing)))
+        else:
+            journal.add('pdf', output_name, converted)
+
+    for lower_journal in lower_journals:
+        lower_journal.close()
+    return stages
 
 
 def subset_pages(pages, pages_range):
@@ -375,33 +829,196 @@ def subset_pages(pages, pages_range):
     return pages[a:b]
 
 
-def download_manuscript(pages_range, resolution, base_dir, manuscript):
+def download_manuscript(pages_range, resolution, base_dir, manuscript,
+                        workers, embed_jpeg=False, derive_from=None,
+                        pyramid=0, append=False, dzi=False,
+                        all_pages=None, report=print_line):
     '''
-    Download whole manuscript. The result is a pdf file.
+    Download whole manuscript. The result is a pdf file. If derive_from is
+    set, pages already downloaded at that higher resolution are scaled down
+    instead of downloaded again. If append is set, pages are added to a
+    single PDF of the resolution, so a manuscript can be grown in slices.
+    If dzi is set, pages are written as Deep Zoom images instead of a PDF.
+    all_pages is the page list of the manuscript if it is already known.
+    Progress lines go to report.
     '''
-    print('Downloading manuscript {0} resolution {1}'
-          .format(manuscript, resolution))
+    report('Downloading manuscript {0} resolution {1}'
+           .format(manuscript, resolution))
 
     # Get list of pages
-    pages = get_pages(manuscript)
-    print('{0} pages found'.format(len(pages)))
-    pages = subset_pages(pages, pages_range)
-    print('{0} pages downloading (range {1})'.format(len(pages), pages_range))
+    if all_pages is None:
+        all_pages = get_pages(manuscript)
+    report('{0} pages found'.format(len(all_pages)))
+    pages = subset_pages(all_pages, pages_range)
+    report('{0} pages downloading (range {1})'.format(len(pages),
+                                                      pages_range))
 
-    # Download all pages
-    download_pages(resolution, base_dir, manuscript, pages)
+    journal = open_journal(base_dir, manuscript)
 
-    # Convert pages from jpg to pdf and join into single pdf
-    print('Converting manuscript {0} into PDF'.format(manuscript))
-    convert_manuscript(resolution, base_dir, manuscript, pages)
+    if derive_from is not None:
+        derive_pages(derive_from, resolution, base_dir, manuscript, pages,
+                     journal, workers)
+
+    # Download all pages, convert them from jpg to pdf and join into single pdf
+    stages = process_pages(resolution, base_dir, manuscript, pages, journal,
+                           workers, embed_jpeg, pyramid,
+                           all_pages if append else None, dzi, report)
+    journal.close()
+    return stages
+
+
+def page_tasks(resolution, base_dir, manuscript, workers, embed_jpeg, journal,
+               queue):
+    '''
+    Handlers of worker mode tasks. Every page goes through download, stitch
+    and encode tasks, each of them may be done by a different worker, so the
+    journal is reloaded to see what the others have done. Encoded pages are
+    kept on disk, write puts them into the PDF once all pages are through.
+    '''
+    encoded_dir = J(base_dir, manuscript, 'encoded')
+    mkpath(encoded_dir)
+
+    def download(task):
+        journal.reload()
+        page = task.key
+        if journal.has('page', page):
+            return None, [('encode', page, '')]
+        columns, rows = download_page(resolution, base_dir, manuscript, page,
+                                      journal, workers.tiles)
+        return None, [('stitch', page, '{0},{1}'.format(columns, rows))]
+
+    def stitch(task):
+        journal.reload()
+        columns, rows = map(int, task.payload.split(','))
+        concatenate_page(base_dir, manuscript, task.key, columns, rows,
+                         journal)
+        if not journal.has('page', task.key):
+            # There is nothing to encode, write leaves the page out
+            return None, []
+        return None, [('encode', task.key, '')]
+
+    def encode(task):
+        page_filename = J(base_dir, manuscript, '{0}.jpg'.format(task.key))
+        if embed_jpeg:
+            # Stitched pages are JPEGs, they go into the PDF as they are
+            image = read_jpeg(page_filename)
+            filename = page_filename
+        else:
+            image = encode_image(page_filename)
+            filename = J(encoded_dir, '{0}.jpg'.format(task.key))
+            spit_bytes(image.jpeg, filename)
+        return json.dumps({'filename': filename, 'size': image.size,
+                           'dpi': image.dpi, 'colorspace': image.colorspace,
+                           'decode': image.decode}), []
+
+    def write(task):
+        pages = task.payload.split(',')
+        journal.reload()
+        if (journal.get('pdf', task.key) == task.payload and
+                os.path.exists(task.key)):
+            print('{0} is up to date'.format(task.key))
+            return None, []
+        missing = []
+        with PdfWriter(task.key) as writer:
+            for page in pages:
+                result = queue.result('encode', page)
+                if result is None:
+                    print('Page {0} is missing'.format(page))
+                    missing.append(page)
+                    continue
+                image = json.loads(result)
+                with open(image['filename'], 'rb') as f:
+                    jpeg = f.read()
+                writer.add_page(image['size'], image['dpi'],
+                                image['colorspace'], jpeg, image['decode'])
+        if missing:
+            # Not recorded, so that the next run writes it again
+            print('Written {0} without {1} pages, run again to complete it'
+                  .format(task.key, len(missing)))
+            return None, []
+        journal.add('pdf', task.key, task.payload)
+        print('Written {0}'.format(task.key))
+        return None, []
+
+    def timed(handler):
+        def run(task):
+            print('{0} {1}'.format(task.kind, task.key))
+            with metrics.timed('task.' + task.kind, key=task.key):
+                return handler(task)
+        return run
+
+    return {'download': timed(download), 'stitch': timed(stitch),
+            'encode': timed(encode), 'write': timed(write)}
+
+
+def work_on_manuscript(pages_range, resolution, base_dir, manuscript,
+                       workers, embed_jpeg=False, lease_time=600):
+    '''
+    Worker mode: take page tasks of the manuscript from a queue shared with
+    other worker processes, possibly on other hosts with the same base_dir
+    mounted, until the PDF is written. The first worker fills the queue.
+    Tasks that failed in an earlier run are tried again, and so is writing
+    the PDF, which is skipped if it is up to date.
+    '''
+    pages = subset_pages(get_pages(manuscript), pages_range)
+    journal = open_journal(base_dir, manuscript, shared=True)
+    queue = WorkQueue(J(base_dir, manuscript, 'queue.sqlite'), lease_time)
+    output_name = pdf_filename(resolution, base_dir, manuscript, pages)
+    queue.add([('download', page, '') for page in pages])
+    queue.add([('write', output_name, ','.join(pages))], barrier=True)
+    queue.retry([('write', output_name)])
+
+    run_worker(queue, page_tasks(resolution, base_dir, manuscript, workers,
+                                 embed_jpeg, journal, queue))
+    for kind, states in sorted(queue.counts().items()):
+        print('{0}: {1}'.format(kind, ', '.join(
+            '{0} {1}'.format(count, state)
+            for state, count in sorted(states.items()))))
+    queue.close()
+    journal.close()
 
 
 def main(args):
+    if args.worker:
+        # Every process gets its own connections, so they are only opened
+        # after the fork
+        processes = [multiprocessing.Process(target=run_workers, args=(args,))
+                     for _ in range(args.processes - 1)]
+        for process in processes:
+            process.start()
+        run_workers(args)
+        for process in processes:
+            process.join()
+        return
+
     for name in args.names:
         download_manuscript(args.pages,
                             args.resolution,
-                            J(args.base_dir, str(args.resolution)),
-                            name)
+                            level_dir(args.base_dir, args.resolution),
+                            name,
+                            Workers(args.tile_workers, args.page_workers,
+                                    args.stitch_workers, args.encode_workers),
+                            args.embed_jpeg,
+                            args.derive_from,
+                            args.pyramid,
+                            args.append,
+                            args.dzi)
+    for line in metrics.summary():
+        print(line)
+
+
+def run_workers(args):
+    for name in args.names:
+        work_on_manuscript(args.pages,
+                           args.resolution,
+                           level_dir(args.base_dir, args.resolution),
+                           name,
+                           Workers(args.tile_workers, args.page_workers,
+                                   args.stitch_workers, args.encode_workers),
+                           args.embed_jpeg,
+                           args.lease)
+    for line in metrics.summary():
+        print(line)
 
 
 if __name__ == "__main__":
@@ -416,8 +1033,64 @@ if __name__ == "__main__":
                         help='Range of pages to download (both ends including)')
     parser.add_argument('--user-agent', type=str, default=USER_AGENT,
                         help='Fake user agent')
+    parser.add_argument('--tile-workers', type=int, default=4,
+                        help='Number of blocks to download at the same time')
+    parser.add_argument('--page-workers', type=int, default=2,
+                        help='Number of pages to download at the same time')
+    parser.add_argument('--stitch-workers', type=int, default=2,
+                        help='Number of pages to stitch at the same time')
+    parser.add_argument('--encode-workers', type=int, default=2,
+                        help='Number of pages to prepare for PDF at the same time')
+    parser.add_argument('--embed-jpeg', action='store_true',
+                        help='Copy page JPEGs into PDF without re-encoding')
+    parser.add_argument('--derive-from', type=int, default=None,
+                        help='Scale down pages already downloaded at this '
+                        'higher resolution instead of downloading them')
+    parser.add_argument('--pyramid', type=int, default=0,
+                        help='Also build this many lower resolution levels '
+                        'from every downloaded page')
+    parser.add_argument('--append', action='store_true',
+                        help='Add pages to a single PDF of the resolution '
+                        'instead of writing a new one for the page range')
+    parser.add_argument('--dzi', action='store_true',
+                        help='Write every page as a Deep Zoom image (tiles '
+                        'and lower levels) instead of a PDF')
+    parser.add_argument('--worker', action='store_true',
+                        help='Take page tasks from a queue in the manuscript '
+                        'directory, shared with other worker processes')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of worker processes to start on this host')
+    parser.add_argument('--lease', type=int, default=600,
+                        help='Seconds after which a task of a dead worker is '
+                        'given to another one')
+    parser.add_argument('--decode-blocks', action='store_true',
+                        help='Decode every block before saving it, not only '
+                        'check its JPEG markers')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Append every request and stage to this '
+                        'JSON-lines file')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port')
     args = parser.parse_args()
+    if args.derive_from is not None and args.derive_from <= args.resolution:
+        parser.error('--derive-from must be higher than --resolution')
+    if not 0 <= args.pyramid < args.resolution:
+        parser.error('--pyramid must be between 0 and --resolution - 1')
 
     _session.headers.update({'User-Agent': args.user_agent})
-
-    sys.exit(main(args))
+    # Requests in flight are adjusted between 1 and --tile-workers depending on
+    # how the Library responds
+    _governor.maximum = args.tile_workers
+    DECODE_BLOCKS = args.decode_blocks
+    # Let every tile worker keep its own connection to the Proxy
+    _session.mount('http://', requests.adapters.HTTPAdapter(
+        pool_maxsize=max(args.tile_workers, 10)))
+    if args.trace:
+        metrics.open_trace(args.trace)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    try:
+        sys.exit(main(args))
+    finally:
+        metrics.close()
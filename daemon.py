@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+#
+# Stay resident and take download jobs over a local HTTP API.
+#
+# Jobs are lines of batch.py job lists. Everything that a single run sets up
+# from scratch is kept between jobs: the HTTP session with its connection
+# pools and rate governors, the tile cache, page lists of British Library
+# manuscripts, parsed nb.no manifests and the threads that run the jobs.
+#
+#   $ python3 daemon.py --port 8765 --jobs 4
+#   $ curl -d 'bl add_ms_24686 --pages 0:3' localhost:8765/jobs
+#   $ curl localhost:8765/jobs/1/events    # progress, one JSON per line
+#   $ curl localhost:8765/jobs
+#
+# With --socket the API is served on a Unix socket instead:
+#
+#   $ curl --unix-socket /tmp/manuscript-dl.sock localhost/jobs
+#
+# API:
+#
+#   POST /jobs               job lines in the body, returns the new jobs;
+#                            jobs of the same manuscript run one after
+#                            another
+#   GET  /jobs               all jobs
+#   GET  /jobs/{n}           one job
+#   GET  /jobs/{n}/events    events of the job so far, then new ones as they
+#                            come until the job is finished
+#   GET  /metrics            metrics in Prometheus format
+
+import argparse
+import json
+import logging
+import os
+import re
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shutil import which
+from urllib.parse import urlsplit
+
+from batch import Batch, read_jobs, share_transport
+from manuscript_dl import transport
+from manuscript_dl.cache import HttpCache
+from manuscript_dl.metrics import metrics
+from manuscript_dl.pipeline import print_line
+from manuscript_dl.scripts import load_script
+
+FINISHED = ('done', 'failed')
+
+
+class Daemon(Batch):
+    def __init__(self, args):
+        super().__init__([], args)
+        self.cache = HttpCache(args.cache_dir, args.cache_size * 1024 * 1024,
+                               args.manifest_ttl * 3600)
+        self.executor = ThreadPoolExecutor(args.jobs)
+        self.changed = threading.Condition(self.lock)
+        self.page_lists = {}
+        self.manifests = {}
+
+    def remember(self, known, key, load):
+        '''
+        Value of key loaded once per --manifest-ttl hours.
+        '''
+        with self.lock:
+            loaded, value = known.get(key, (0, None))
+        if time.time() - loaded > self.args.manifest_ttl * 3600:
+            value = load()
+            with self.lock:
+                known[key] = (time.time(), value)
+        return value
+
+    def get_pages(self, bl, manuscript):
+        return self.remember(self.page_lists, manuscript,
+                             lambda: bl.get_pages(manuscript))
+
+    def get_manifest(self, nb, id, downloader):
+        return self.remember(self.manifests, id,
+                             lambda: nb.get_manifest(id, downloader))
+
+    def event(self, job, event, fields):
+        with self.changed:
+            job.events.append(dict(fields, job=job.number, event=event,
+                                   time=round(time.time(), 3)))
+            self.changed.notify_all()
+
+    def report(self, job):
+        super().report(job)
+        self.event(job, 'status', job.as_dict())
+
+    def progress(self, job, line):
+        self.event(job, 'progress', {'message': line})
+
+    def submit(self, lines):
+        '''
+        Queue jobs given as job list lines. Only the last --history finished
+        jobs are kept.
+        '''
+        jobs = read_jobs(lines)
+        with self.lock:
+            for job in jobs:
+                job.number = self.jobs[-1].number + 1 if self.jobs else 1
+                job.events = []
+                self.jobs.append(job)
+            finished = [job for job in self.jobs if job.status in FINISHED]
+            for job in finished[:max(0, len(finished) - self.args.history)]:
+                self.jobs.remove(job)
+        for job in jobs:
+            self.event(job, 'status', job.as_dict())
+            self.start(job)
+        return jobs
+
+    def find(self, number):
+        with self.lock:
+            for job in self.jobs:
+                if job.number == number:
+                    return job
+        return None
+
+    def follow(self, job):
+        '''
+        Yield events of the job, waiting for new ones until the job is
+        finished.
+        '''
+        sent = 0
+        while True:
+            with self.changed:
+                while sent == len(job.events):
+                    self.changed.wait()
+                events = job.events[sent:]
+            for event in events:
+                yield event
+            sent += len(events)
+            last = events[-1]
+            if last['event'] == 'status' and last['status'] in FINISHED:
+                return
+
+    def close(self):
+        self.executor.shutdown()
+        self.cache.close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    daemon = None
+
+    def log_message(self, format, *args):
+        logging.info('%s', format % args)
+
+    def reply(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body, indent=4) + '\n'
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == '/jobs':
+            with self.daemon.lock:
+                jobs = [job.as_dict() for job in self.daemon.jobs]
+            return self.reply(200, jobs)
+        if path == '/metrics':
+            return self.reply(200, metrics.prometheus(),
+                              'text/plain; version=0.0.4; charset=utf-8')
+        match = re.match(r'^/jobs/(\d+)(/events)?$', path)
+        job = match and self.daemon.find(int(match.group(1)))
+        if not job:
+            return self.reply(404, {'error': 'no such job'})
+        if not match.group(2):
+            return self.reply(200, job.as_dict())
+
+        # No length, the stream ends when the connection is closed
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for event in self.daemon.follow(job):
+                self.wfile.write((json.dumps(event) + '\n').encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        lines = self.rfile.read(length).decode().splitlines()
+        try:
+            jobs = self.daemon.submit(lines)
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(202, [job.as_dict() for job in jobs])
+
+
+class UnixHandler(Handler):
+    def address_string(self):
+        return 'unix'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(daemon, args):
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        handler = type('Handler', (UnixHandler,), {'daemon': daemon})
+        return ThreadingUnixHTTPServer(args.socket, handler)
+    handler = type('Handler', (Handler,), {'daemon': daemon})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Keep downloaders running and take jobs over HTTP')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port to listen on')
+    parser.add_argument('--socket', default=None,
+                        help='Listen on this Unix socket instead of a port')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='Number of jobs to run at the same time')
+    parser.add_argument('--history', type=int, default=1000,
+                        help='Number of finished jobs to remember')
+    parser.add_argument('--base-dir', default='pics',
+                        help='Base directory of British Library manuscripts')
+    parser.add_argument('--tile-workers', type=int, default=8,
+                        help='Number of requests in flight per host, '
+                        'across all jobs')
+    parser.add_argument('--page-workers', type=int, default=2,
+                        help='Number of pages to download at the same time, per job')
+    parser.add_argument('--stitch-workers', type=int, default=2,
+                        help='Number of pages to stitch at the same time, per job')
+    parser.add_argument('--encode-workers', type=int, default=2,
+                        help='Number of pages to prepare for PDF at the same '
+                        'time, per job')
+    parser.add_argument('--memory-budget', type=int, default=1024,
+                        help='Memory for nb.no page images in flight, MiB, '
+                        'across all jobs')
+    parser.add_argument('--pool-hosts', type=int, default=4,
+                        help='Number of hosts to keep connection pools for')
+    parser.add_argument('--cache-dir', default=None,
+                        help='HTTP cache directory of nb.no jobs')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='Size limit of cached tiles, MiB')
+    parser.add_argument('--manifest-ttl', type=int, default=24,
+                        help='Hours to keep manifests and page lists')
+    parser.add_argument('--status', default=None,
+                        help='Keep status of all jobs in this JSON file')
+    parser.add_argument('--trace', default=None,
+                        help='Append every request and stage to this JSON-lines file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    # Both downloaders are loaded once, checks are done once
+    share_transport()
+    nb = load_script('nb.no.py')
+    if args.cache_dir is None:
+        args.cache_dir = nb.CACHE_DIR
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    for name in ('pdftk', 'tesseract'):
+        if not which(name):
+            logging.warning('%s is missing, nb jobs need --no-ocr', name)
+
+    transport.configure_pool(args.pool_hosts, args.tile_workers,
+                             args.tile_workers)
+    if args.trace:
+        metrics.open_trace(args.trace)
+
+    daemon = Daemon(args)
+    server = make_server(daemon, args)
+    print_line('[daemon] listening on {}'.format(
+        args.socket or '{}:{}'.format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+        metrics.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
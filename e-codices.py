@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+#
+# Download manuscripts from http://www.e-codices.unifr.ch/en
+#
+# To download a book:
+# 1. Go to book description page: http://www.e-codices.unifr.ch/en/list/one/csg/0369
+# 2. Right click on the link "IIIF Manifest URL" and save it to file
+# 3. Run $ python3 e-codices.py path-to-manifest.json [size]
+#
+# Format:
+# http://sr-svx-93.unifr.ch/loris/kba/kba-BN0049/kba-BN0049_009v.jp2/full/full/0/default.jpg
+# http://sr-svx-93.unifr.ch/loris/kba/kba-BN0049/kba-BN0049_009v.jp2/full/pct:50/0/default.jpg
+
+import argparse
+import logging
+from json import load
+
+from manuscript_dl.iiif import Book
+from manuscript_dl.transport import configure_pool, http_get_sync
+
+FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser('Download manuscripts from e-codices.unifr.ch')
+    parser.add_argument('manifest', help='Path to IIIF manifest file')
+    parser.add_argument('size', nargs='?', type=int, default=None,
+                        help='Size, in percents of original (the original is '
+                        'usually way too big, 50%% is a good start, maybe even 25)')
+    parser.add_argument('--page-workers', type=int, default=4,
+                        help='Number of pages to download at the same time')
+    args = parser.parse_args()
+    configure_pool(1, args.page_workers, args.page_workers)
+
+    with open(args.manifest) as f:
+        manifest = load(f)
+    print(manifest['label'])
+
+    scale = args.size / 100.0 if args.size else 1.0
+    book = Book(manifest, http_get_sync, 'pics', scale=scale,
+                page_workers=args.page_workers)
+    print('{} pages found'.format(len(book.pages())))
+    book.download()
+    book.write_pdf('{}.pdf'.format(manifest['label']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+'''
+Code shared by the downloaders in this repository.
+'''
@@ -0,0 +1,116 @@
+'''
+On-disk HTTP response cache for IIIF downloads.
+
+Entries are keyed on the normalised URL only, so request headers (cookies)
+do not affect hits. Image requests and everything else (manifests, info.json)
+are kept in separate caches with their own policies: images are evicted in
+least-recently-used order once the cache outgrows its size limit, other
+documents expire after a while because they may change on the server.
+
+Image bytes are stored once per content hash, URLs only point to them, so
+identical tiles (blank margins, colour charts) take space once.
+'''
+
+import re
+import threading
+from collections import Counter
+from os.path import join
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from diskcache import Cache
+
+from manuscript_dl.metrics import metrics
+from manuscript_dl.tilestore import content_hash
+
+# {region}/{size}/{rotation}/{quality}.{format} at the end of IIIF image URL
+IIIF_IMAGE_REQUEST = re.compile(
+    r'/[^/]+/[^/]+/!?\d+(\.\d+)?/(default|color|gray|bitonal|native)'
+    r'\.(jpg|jpeg|png|gif|webp|tif|jp2)$')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    '''
+    Lower case scheme and host, drop default port, repeated slashes, fragment
+    and order of query parameters.
+    '''
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = '{}:{}'.format(host, parts.port)
+    path = re.sub('/{2,}', '/', parts.path)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+def is_image_url(url):
+    return IIIF_IMAGE_REQUEST.search(urlsplit(url).path) is not None
+
+
+class HttpCache:
+    def __init__(self, directory, size_limit=4 * 1024 ** 3,
+                 document_expire=24 * 3600):
+        self.document_expire = document_expire
+        self.documents = Cache(join(directory, 'documents'),
+                               eviction_policy='none')
+        self.images = Cache(join(directory, 'images'),
+                            eviction_policy='least-recently-used')
+        self.blobs = Cache(join(directory, 'blobs'), size_limit=size_limit,
+                           eviction_policy='least-recently-used')
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, **kwargs):
+        with self.lock:
+            self.stats.update(kwargs)
+
+    def get(self, url, fetch):
+        '''
+        Return cached response for url or call fetch(url) and cache its
+        result. Failed requests (None) are not cached.
+        '''
+        key = normalize_url(url)
+        image = is_image_url(url)
+        cache = self.images if image else self.documents
+
+        data = cache.get(key)
+        if image and isinstance(data, str):
+            # Blob may have been evicted since
+            data = self.blobs.get(data)
+        if data is not None:
+            self.count(hits=1, hit_bytes=len(data))
+            metrics.count('cache.hit', url=url, bytes=len(data))
+            return data
+
+        data = fetch(url)
+        self.count(misses=1)
+        metrics.count('cache.miss', url=url)
+        if data is not None:
+            self.count(miss_bytes=len(data))
+            if image:
+                hash = content_hash(data)
+                if hash not in self.blobs:
+                    self.blobs.set(hash, data)
+                else:
+                    self.count(duplicates=1)
+                self.images.set(key, hash)
+            else:
+                self.documents.set(key, data, expire=self.document_expire)
+        return data
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return ('hits {hits} ({hit_bytes} bytes), misses {misses} '
+                '({miss_bytes} bytes), duplicate images {duplicates}, '
+                'images on disk {volume} bytes').format(
+                    volume=self.blobs.volume(),
+                    **{k: stats.get(k, 0) for k in
+                       ('hits', 'hit_bytes', 'misses', 'miss_bytes',
+                        'duplicates')})
+
+    def close(self):
+        self.documents.close()
+        self.images.close()
+        self.blobs.close()
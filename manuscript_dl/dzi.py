@@ -0,0 +1,132 @@
+'''
+Streaming Deep Zoom (DZI) writer.
+
+Tiles of the full size level are written as they arrive, JPEG bytes are
+copied as they are. Every tile of a lower level is built from the (up to)
+four tiles under it as soon as they are all on disk, so no level is ever
+held in memory as a whole: memory use depends on tile size, not page size.
+
+    page.dzi
+    page_files/{level}/{column}_{row}.jpg
+
+The descriptor is written last, a page with a descriptor is complete.
+'''
+
+import math
+import os
+import threading
+from io import BytesIO
+from os.path import exists, join
+
+from PIL import Image
+
+JPEG_QUALITY = 90
+DESCRIPTOR = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpg" Overlap="0" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+'''
+
+
+def write_file(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(filename + '.tmp', filename)
+
+
+class DziWriter:
+    def __init__(self, directory, name, width, height, tile_size):
+        self.descriptor = join(directory, name + '.dzi')
+        self.files = join(directory, name + '_files')
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        # Level 0 is a single pixel, the top level is the full size image
+        self.max_level = int(math.ceil(math.log(max(width, height, 2), 2)))
+        self.done = set()
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self):
+        return exists(self.descriptor)
+
+    def level_size(self, level):
+        scale = 2 ** (self.max_level - level)
+        return (int(math.ceil(self.width / float(scale))),
+                int(math.ceil(self.height / float(scale))))
+
+    def grid(self, level):
+        width, height = self.level_size(level)
+        return (int(math.ceil(width / float(self.tile_size))),
+                int(math.ceil(height / float(self.tile_size))))
+
+    def tile_path(self, level, column, row):
+        return join(self.files, str(level), '{}_{}.jpg'.format(column, row))
+
+    def children(self, level, column, row):
+        columns, rows = self.grid(level + 1)
+        return [(level + 1, c, r)
+                for r in (2 * row, 2 * row + 1) if r < rows
+                for c in (2 * column, 2 * column + 1) if c < columns]
+
+    def put_tile(self, column, row, data):
+        '''
+        Add JPEG tile of the full size level and build the lower level tiles
+        it completes.
+        '''
+        write_file(self.tile_path(self.max_level, column, row), data)
+        self.finished(self.max_level, column, row)
+
+    def finished(self, level, column, row):
+        while level > 0:
+            parent = (level - 1, column // 2, row // 2)
+            with self.lock:
+                self.done.add((level, column, row))
+                ready = (parent not in self.done and
+                         all(child in self.done
+                             for child in self.children(*parent)))
+                if ready:
+                    # Claim it, so that no other thread builds it too
+                    self.done.add(parent)
+            if not ready:
+                return
+            self.build(*parent)
+            level, column, row = parent
+
+    def build(self, level, column, row):
+        '''
+        Downscale the tiles under this one by half. Missing tiles (failed
+        downloads) are left black.
+        '''
+        x0, y0 = 2 * column * self.tile_size, 2 * row * self.tile_size
+        width, height = self.level_size(level + 1)
+        canvas = Image.new('RGB', (min(2 * self.tile_size, width - x0),
+                                   min(2 * self.tile_size, height - y0)))
+        for child_level, c, r in self.children(level, column, row):
+            path = self.tile_path(child_level, c, r)
+            if exists(path):
+                with Image.open(path) as tile:
+                    canvas.paste(tile, (c * self.tile_size - x0,
+                                        r * self.tile_size - y0))
+        output = BytesIO()
+        canvas.reduce(2).save(output, 'JPEG', quality=JPEG_QUALITY)
+        write_file(self.tile_path(level, column, row), output.getvalue())
+
+    def close(self):
+        '''
+        Build lower level tiles that are still missing because some full
+        size tiles never arrived, then write the descriptor.
+        '''
+        for level in reversed(range(self.max_level)):
+            columns, rows = self.grid(level)
+            for row in range(rows):
+                for column in range(columns):
+                    with self.lock:
+                        missing = (level, column, row) not in self.done
+                        self.done.add((level, column, row))
+                    if missing:
+                        self.build(level, column, row)
+        write_file(self.descriptor, DESCRIPTOR.format(
+            tile_size=self.tile_size, width=self.width,
+            height=self.height).encode())
@@ -0,0 +1,275 @@
+'''
+Download engine for libraries that publish IIIF Presentation manifests.
+
+Book walks sequences -> canvases -> images of the manifest and downloads
+every image through its Image API service, either whole at a given size or
+in tiles that are stitched into a page. Pages are fetched concurrently, pages
+that are already on disk are not downloaded again, and the result can be
+written into a PDF in one pass.
+'''
+
+import logging
+import math
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from json import dumps, loads
+from multiprocessing.pool import ThreadPool
+from os import makedirs
+from os.path import dirname, exists, join
+
+from PIL import Image
+
+from manuscript_dl.dzi import DziWriter
+from manuscript_dl.memory import MemoryBudget
+from manuscript_dl.metrics import metrics
+from manuscript_dl.pdf import write_pdf
+
+Shape = namedtuple('Shape', ['width', 'height'])
+Tile = namedtuple('Tile', ['width', 'scale'])
+Page = namedtuple('Page', ['id', 'url', 'index', 'shape', 'tile', 'service'])
+
+def ensure_dir(filename):
+    dir = dirname(filename)
+    if dir and not exists(dir):
+        makedirs(dir, exist_ok=True)
+    return filename
+
+def spit(data, filename):
+    with open(ensure_dir(filename), 'w') as f:
+        f.write(data)
+
+def spit_bytes(data, filename):
+    # Write next to the target and rename, so that a page on disk is always
+    # complete
+    tmp = ensure_dir(filename) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+def fs_friendly(path):
+    # return re.sub(r'[^a-zA-Z0-9_\-\.]', '_', path)
+    return path.replace('/', '_').replace(':', '_')
+
+def service_url(image):
+    '''
+    Base URL of the image service of a manifest image. Older manifests
+    without a service only have the full image URL.
+    '''
+    resource = image['resource']
+    service = resource.get('service')
+    if service:
+        return service['@id'].rstrip('/')
+    return re.sub(r'/full/[^/]+/\d+/default\.\w+$', '', resource['@id'])
+
+def profile_limits(info):
+    '''
+    maxWidth, maxHeight and maxArea of the image service, if any. IIIF 2 keeps
+    them in the profile list, IIIF 3 at the top level.
+    '''
+    limits = dict(info)
+    profile = info.get('profile')
+    for entry in profile if isinstance(profile, list) else []:
+        if isinstance(entry, dict):
+            limits.update(entry)
+    return limits.get('maxWidth'), limits.get('maxHeight'), limits.get('maxArea')
+
+def choose_tile(info, shape: Shape, scale, default_width=1024):
+    '''
+    Pick the largest tile the image service allows and the scale to request.
+    If the service only serves some scale factors, the scale is rounded up to
+    the nearest one.
+    '''
+    tiles = info.get('tiles') or []
+    factors = sorted({f for tile in tiles for f in tile.get('scaleFactors', [])})
+    if factors:
+        allowed = [f for f in factors if 1.0 / f >= scale - 1e-9] or [1]
+        snapped = 1.0 / max(allowed)
+        if snapped != scale:
+            logging.info('scale %s is not served, using %s', scale, snapped)
+        scale = snapped
+
+    width = max([tile['width'] for tile in tiles] or [default_width])
+    max_width, max_height, max_area = profile_limits(info)
+    out_width = math.ceil(shape.width * scale)
+    out_height = math.ceil(shape.height * scale)
+    # Whole page in one request if the service lists the size we need
+    for size in info.get('sizes') or []:
+        if size['width'] == out_width and size['height'] == out_height:
+            width = max(out_width, out_height)
+    limits = [limit for limit in (max_width, max_height) if limit]
+    if max_area:
+        limits.append(int(math.sqrt(max_area)))
+    if limits:
+        # Any region can be requested as long as the result fits the limits
+        width = max(width, min(limits + [max(out_width, out_height)]))
+    return Tile(width, scale)
+
+class Book:
+    '''
+    If tiled is set, pages are downloaded in tiles and stitched into
+    page_format images. Tile size is the largest one the image service allows.
+    Otherwise every page is downloaded whole and saved as it is. Either way
+    pages are requested from the server already scaled. If dzi is set, tiles
+    are written into a Deep Zoom image of every page instead, see DziWriter.
+    '''
+    page_format = 'png'
+
+    def __init__(self, manifest, downloader, dir, tiled=False, scale=1.0,
+                 page_workers=1, tile_workers=4,
+                 memory_budget=1024 * 1024 * 1024, dzi=False):
+        self.manifest = manifest
+        self.downloader = downloader
+        self.dir = dir
+        self.tiled = tiled
+        self.scale = scale
+        self.page_workers = page_workers
+        self.tile_workers = tile_workers
+        self.memory = MemoryBudget(memory_budget)
+        self.label = fs_friendly(manifest['label'])
+        self.dzi = dzi
+        # Called with every page once it is on disk
+        self.progress = None
+
+    def page_id(self, url):
+        return fs_friendly(url.split('/')[-1])
+
+    def pages(self):
+        pages = []
+        index = 0
+        for sequence in self.manifest['sequences']:
+            for canvas in sequence['canvases']:
+                for image in canvas['images']:
+                    url = service_url(image)
+                    service = image['resource'].get('service') or {}
+                    page_shape = Shape(
+                        service.get('width', canvas.get('width')),
+                        service.get('height', canvas.get('height')))
+                    pages.append(Page(self.page_id(url), url, index,
+                                      page_shape, None, service))
+                    index += 1
+        return pages
+
+    def page_filename(self, page: Page):
+        ext = self.page_format if self.tiled else 'jpg'
+        return join(self.dir, '{:04d}_{}.{}'.format(page.index, page.id, ext))
+
+    def service_info(self, page: Page):
+        '''
+        Image service description. Manifests often embed it, otherwise it is
+        read from info.json.
+        '''
+        if any(key in page.service for key in ('tiles', 'sizes', 'profile')):
+            return page.service
+        data = self.downloader(page.url + '/info.json')
+        return loads(data) if data else {}
+
+    def get_tile(self, page: Page, ox, oy, ow, oh):
+        # Region is in full size coordinates, size in scaled ones
+        x, y = round(ox / page.tile.scale), round(oy / page.tile.scale)
+        w = min(round((ox + ow) / page.tile.scale), page.shape.width) - x
+        h = min(round((oy + oh) / page.tile.scale), page.shape.height) - y
+        tile_url = page.url + '/{},{},{},{}/{},/0/default.jpg'.format(
+            x, y, w, h, ow)
+        return self.downloader(tile_url)
+
+    def get_image(self, page: Page):
+        filename = self.page_filename(page)
+        if exists(filename): return
+        size = 'full' if self.scale == 1 else 'pct:{:g}'.format(self.scale * 100)
+        data = self.downloader(page.url + '/full/{}/0/default.jpg'.format(size))
+        if data is None:
+            logging.error('failed to download page %s', page.url)
+            return
+        spit_bytes(data, filename)
+        logging.info('saved %s', filename)
+
+    def tile_positions(self, page: Page):
+        width = math.ceil(page.shape.width * page.tile.scale)
+        height = math.ceil(page.shape.height * page.tile.scale)
+        step = page.tile.width
+        positions = [(ox, oy, min(step, width - ox), min(step, height - oy))
+                     for oy in range(0, height, step)
+                     for ox in range(0, width, step)]
+        return width, height, positions
+
+    def get_dzi(self, page: Page):
+        '''
+        Write tiles into a Deep Zoom image as they arrive, without re-encoding
+        them and without a page canvas.
+        '''
+        page = page._replace(tile=choose_tile(self.service_info(page),
+                                              page.shape, self.scale))
+        width, height, positions = self.tile_positions(page)
+        step = page.tile.width
+        writer = DziWriter(join(self.dir, 'dzi'),
+                           '{:04d}_{}'.format(page.index, page.id),
+                           width, height, step)
+        if writer.complete: return
+        futures = {self.tiles.submit(self.get_tile, page, *position): position
+                   for position in positions}
+        for future in as_completed(futures):
+            data = future.result()
+            if data is not None:
+                ox, oy = futures[future][:2]
+                with metrics.timed('dzi', page=page.id):
+                    writer.put_tile(ox // step, oy // step, data)
+        with metrics.timed('dzi', page=page.id):
+            writer.close()
+        logging.info('saved %s', writer.descriptor)
+
+    def get_page(self, page: Page):
+        if not self.tiled:
+            return self.get_image(page)
+        if self.dzi:
+            return self.get_dzi(page)
+        filename = self.page_filename(page)
+        if exists(filename): return
+        page = page._replace(tile=choose_tile(self.service_info(page),
+                                              page.shape, self.scale))
+        width, height, positions = self.tile_positions(page)
+        # Page canvas is only allocated once it fits into the memory budget
+        canvas_size = width * height * 3
+        with self.memory.reserve(canvas_size):
+            futures = {self.tiles.submit(self.get_tile, page, *position): position
+                       for position in positions}
+            img = Image.new('RGB', (width, height))
+            for future in as_completed(futures):
+                data = future.result()
+                if data is not None:
+                    with metrics.timed('paste', page=page.id):
+                        tile = Image.open(BytesIO(data))
+                        img.paste(tile, futures[future][:2])
+            with metrics.timed('save', page=page.id):
+                img.save(ensure_dir(filename))
+        logging.info('saved %s', filename)
+
+    def download(self):
+        spit(dumps(self.manifest, indent=4), join(self.dir, 'manifest.json'))
+        tasks = self.pages()
+        with ThreadPoolExecutor(self.tile_workers) as self.tiles, \
+                ThreadPool(self.page_workers) as pool:
+            for page, _ in zip(tasks, pool.imap(self.get_page, tasks)):
+                if self.progress:
+                    self.progress(page)
+
+    def write_pdf(self, filename):
+        '''
+        Write downloaded pages into PDF in one pass. JPEG pages are copied
+        without re-encoding.
+        '''
+        images = []
+        for page in self.pages():
+            image = self.page_filename(page)
+            if exists(image):
+                images.append(image)
+            else:
+                logging.error('missing page %s', image)
+
+        def progress(i, image):
+            logging.info('adding %d/%d %s', i + 1, len(images), image)
+
+        with metrics.timed('pdf'):
+            write_pdf(filename, images, progress, embed_jpeg=True)
@@ -0,0 +1,97 @@
+'''
+Journal of finished work, kept next to the downloaded files so that an
+interrupted download can be resumed without checking every file on disk.
+
+Entries are (kind, key, value) triples in a SQLite database, e.g.
+('block', 'f001r/3_7', '') or ('grid', 'f001r', '34,25'). The whole journal is
+loaded into memory when opened, every new entry is written through.
+
+A journal that is shared by worker processes, possibly on other hosts, keeps
+the rollback journal instead of WAL, and is reloaded to see their entries.
+'''
+
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (kind, key)
+)
+'''
+# Set once files that existed before the journal have been recorded
+IMPORTED = ('journal', 'imported')
+
+
+class Journal:
+    def __init__(self, filename, shared=False):
+        self.filename = filename
+        self.shared = shared
+        self.lock = threading.Lock()
+        try:
+            self.db, self.entries = self.load()
+        except sqlite3.DatabaseError:
+            # Start over, caller will fill the journal from the files on disk
+            os.replace(filename, filename + '.corrupt')
+            self.db, self.entries = self.load()
+
+    def load(self):
+        db = sqlite3.connect(self.filename, timeout=60,
+                             check_same_thread=False)
+        try:
+            if not self.shared:
+                db.execute('PRAGMA journal_mode=WAL')
+                db.execute('PRAGMA synchronous=NORMAL')
+            elif db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+                try:
+                    db.execute('PRAGMA journal_mode=DELETE')
+                except sqlite3.OperationalError:
+                    # Still open elsewhere in WAL mode, switched by whoever
+                    # opens it alone next
+                    pass
+            db.execute(SCHEMA)
+            entries = self.read_entries(db)
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db, entries
+
+    def read_entries(self, db):
+        entries = {}
+        for kind, key, value in db.execute(
+                'SELECT kind, key, value FROM entries'):
+            entries.setdefault(kind, {})[key] = value
+        return entries
+
+    def reload(self):
+        '''
+        Pick up entries added by other processes.
+        '''
+        with self.lock:
+            self.entries = self.read_entries(self.db)
+
+    @property
+    def imported(self):
+        return self.has(*IMPORTED)
+
+    def mark_imported(self):
+        self.add(*IMPORTED)
+
+    def has(self, kind, key):
+        return key in self.entries.get(kind, ())
+
+    def get(self, kind, key, default=None):
+        return self.entries.get(kind, {}).get(key, default)
+
+    def add(self, kind, key, value=''):
+        with self.lock:
+            self.entries.setdefault(kind, {})[key] = value
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                                (kind, key, value))
+
+    def close(self):
+        self.db.close()
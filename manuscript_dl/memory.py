@@ -0,0 +1,31 @@
+'''
+Memory budget shared by workers that hold large images.
+'''
+
+import threading
+from contextlib import contextmanager
+
+
+class MemoryBudget:
+    '''
+    Workers reserve the number of bytes they are about to allocate and block
+    until it fits into the budget. A reservation larger than the whole budget
+    is let through when nothing else is reserved, so it cannot block forever.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used -= size
+                self.condition.notify_all()
@@ -0,0 +1,210 @@
+'''
+Run metrics shared by the downloaders.
+
+Every HTTP request, pipeline stage and CPU heavy step (stitching, encoding,
+converting) is recorded as an event with its wall time and, where it makes
+sense, CPU time and number of bytes. Events can be written into a JSON-lines
+trace as they happen; at the end of the run the summary gives count, total
+and p50/p95/p99 latency of every kind of event, plus plain counters (invalid
+blocks, retries, throttled responses, cache hits). The same numbers can be
+served in Prometheus text format while the run is going. Percentiles are
+taken from a bounded sample, so a resident process does not keep every
+event.
+'''
+
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Number of durations kept per kind of event for percentiles
+RESERVOIR_SIZE = 10000
+
+
+def percentile(values, quantile):
+    '''
+    Nearest-rank percentile of sorted values.
+    '''
+    if not values:
+        return 0.0
+    rank = max(1, int(math.ceil(quantile * len(values))))
+    return values[rank - 1]
+
+
+class Reservoir:
+    '''
+    Count and total of all values and a uniform random sample of at most
+    size of them (reservoir sampling).
+    '''
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.values = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.size:
+                self.values[i] = value
+
+
+class Metrics:
+    def __init__(self):
+        self.durations = defaultdict(Reservoir)
+        self.cpu = defaultdict(float)
+        self.bytes = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.trace = None
+        self.server = None
+        self.lock = threading.Lock()
+
+    def open_trace(self, filename):
+        self.trace = open(filename, 'a', buffering=1)
+
+    def write_event(self, event):
+        # Called with the lock held, so that lines do not mix
+        if self.trace is not None:
+            event['time'] = round(time.time(), 6)
+            self.trace.write(json.dumps(event) + '\n')
+
+    def count(self, name, value=1, **fields):
+        '''
+        Increase counter name, e.g. number of invalid blocks.
+        '''
+        with self.lock:
+            self.counters[name] += value
+            self.write_event(dict(fields, event=name, count=value))
+
+    def observe(self, name, duration, size=0, cpu=None, **fields):
+        '''
+        Record one event of kind name that took duration seconds.
+        '''
+        with self.lock:
+            self.durations[name].add(duration)
+            self.bytes[name] += size
+            event = dict(fields, event=name, duration=round(duration, 6))
+            if size:
+                event['bytes'] = size
+            if cpu is not None:
+                self.cpu[name] += cpu
+                event['cpu'] = round(cpu, 6)
+            self.write_event(event)
+
+    @contextmanager
+    def timed(self, name, **fields):
+        '''
+        Record wall and CPU time of the block. CPU time is the one of the
+        calling thread, so blocks should not hand work to other threads.
+        '''
+        started, cpu_started = time.time(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started,
+                         cpu=time.thread_time() - cpu_started, **fields)
+
+    def snapshot(self):
+        with self.lock:
+            return ({name: (durations.count, durations.total,
+                            sorted(durations.values))
+                     for name, durations in self.durations.items()},
+                    dict(self.cpu), dict(self.bytes), dict(self.counters))
+
+    def summary(self):
+        '''
+        Lines with latency percentiles of every kind of event and counters.
+        '''
+        durations, cpu, sizes, counters = self.snapshot()
+        lines = []
+        for name in sorted(durations):
+            count, total, values = durations[name]
+            line = ('{}: {} events, total {:.2f}s, p50 {:.3f}s, p95 {:.3f}s, '
+                    'p99 {:.3f}s').format(
+                        name, count, total,
+                        *[percentile(values, q) for q in QUANTILES])
+            if name in cpu:
+                line += ', cpu {:.2f}s'.format(cpu[name])
+            if sizes.get(name):
+                line += ', {} bytes'.format(sizes[name])
+            lines.append(line)
+        for name in sorted(counters):
+            lines.append('{}: {}'.format(name, counters[name]))
+        return lines
+
+    def prometheus(self):
+        '''
+        All metrics in Prometheus text exposition format.
+        '''
+        durations, cpu, sizes, counters = self.snapshot()
+        lines = ['# TYPE manuscript_dl_seconds summary']
+        for name in sorted(durations):
+            count, total, values = durations[name]
+            for q in QUANTILES:
+                lines.append('manuscript_dl_seconds{{name="{}",quantile="{}"}} {}'
+                             .format(name, q, percentile(values, q)))
+            lines.append('manuscript_dl_seconds_sum{{name="{}"}} {}'
+                         .format(name, total))
+            lines.append('manuscript_dl_seconds_count{{name="{}"}} {}'
+                         .format(name, count))
+        lines.append('# TYPE manuscript_dl_cpu_seconds_total counter')
+        for name in sorted(cpu):
+            lines.append('manuscript_dl_cpu_seconds_total{{name="{}"}} {}'
+                         .format(name, cpu[name]))
+        lines.append('# TYPE manuscript_dl_bytes_total counter')
+        for name in sorted(sizes):
+            lines.append('manuscript_dl_bytes_total{{name="{}"}} {}'
+                         .format(name, sizes[name]))
+        lines.append('# TYPE manuscript_dl_events_total counter')
+        for name in sorted(counters):
+            lines.append('manuscript_dl_events_total{{name="{}"}} {}'
+                         .format(name, counters[name]))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        '''
+        Serve /metrics in Prometheus format from a background thread.
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
+# Shared by all modules of a run
+metrics = Metrics()
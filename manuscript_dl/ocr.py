@@ -0,0 +1,66 @@
+'''
+Per-page OCR with a cache.
+
+Every page image is recognised by tesseract on its own, in a pool of
+processes, into a single page PDF with the image and an invisible text
+layer. Results are cached by SHA-256 of the page image and the language, so
+a re-run only recognises pages that are new or have changed, and the book is
+assembled from the cached pages.
+'''
+
+import hashlib
+import os
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
+from tempfile import gettempdir
+
+CACHE_DIR = join(gettempdir(), 'manuscript-dl', 'ocr')
+
+
+def image_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ocr_page(filename, language, cache_dir=CACHE_DIR):
+    '''
+    Return cached page PDF of the image, running tesseract if there is none
+    yet, whether it was cached and how long it took.
+    '''
+    started = time.time()
+    key = image_hash(filename)
+    output = join(cache_dir, key[:2], '{}-{}.pdf'.format(key, language))
+    if os.path.exists(output):
+        return output, True, time.time() - started
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    # tesseract adds .pdf to the output base name
+    base = '{}.{}.tmp'.format(output[:-len('.pdf')], os.getpid())
+    subprocess.run(['tesseract', filename, base, '-l', language, 'pdf'],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    os.replace(base + '.pdf', output)
+    return output, False, time.time() - started
+
+
+def ocr_pages(filenames, language, cache_dir=CACHE_DIR, jobs=6, progress=None):
+    '''
+    OCR page images in jobs processes, return page PDFs in the same order.
+    progress(i, filename, cached, duration) is called as pages are done.
+    '''
+    pages = []
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(ocr_page, filenames,
+                               [language] * len(filenames),
+                               [cache_dir] * len(filenames))
+        for i, (filename, (page, cached, duration)) in enumerate(
+                zip(filenames, results)):
+            if progress:
+                progress(i, filename, cached, duration)
+            pages.append(page)
+    return pages
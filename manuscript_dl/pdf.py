@@ -0,0 +1,315 @@
+'''
+Streaming PDF writer. Pages are written one by one as soon as they are added,
+so memory usage does not depend on the number of pages, and the document is
+written in a single pass.
+
+    python3 -m manuscript_dl.pdf [--embed-jpeg] output.pdf page1.jpg ...
+
+With --embed-jpeg, JPEG files are copied into the document as they are
+(DCTDecode image streams), without decoding them.
+
+A document written this way can later get more pages with an incremental
+update (PdfUpdater): new objects, a new page tree and a new cross-reference
+section are appended to the end of the file, existing bytes stay as they are.
+'''
+
+import os
+import re
+import sys
+import struct
+import argparse
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+JPEG_QUALITY = 90
+DEFAULT_DPI = 72
+
+# Start of frame markers, they carry image size and number of components
+SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+COLORSPACES = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}
+
+# Object 1 is the catalog, object 2 is the page tree. The page tree is only
+# written when the document is closed, once all its kids are known.
+CATALOG, PAGES = 1, 2
+# Only the end of the file is read to find the last trailer
+TRAILER_WINDOW = 1024
+
+
+class NotJpeg(Exception):
+    pass
+
+
+def read_jpeg_info(data):
+    '''
+    Walk JPEG markers up to the start of frame and return image size, number
+    of components, whether Adobe (inverted CMYK) marker is present and DPI.
+    '''
+    if data[:2] != b'\xff\xd8':
+        raise NotJpeg()
+
+    adobe = False
+    dpi = (DEFAULT_DPI, DEFAULT_DPI)
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xff:
+            raise NotJpeg()
+        marker = data[offset + 1]
+        if marker == 0xff:
+            # Fill byte
+            offset += 1
+            continue
+        length, = struct.unpack('>H', data[offset + 2:offset + 4])
+        segment = data[offset + 4:offset + 2 + length]
+        if marker == 0xe0 and segment[:5] == b'JFIF\x00' and len(segment) >= 12:
+            units = segment[7]
+            density = struct.unpack('>HH', segment[8:12])
+            if units == 1 and all(density):
+                dpi = density
+            elif units == 2 and all(density):
+                dpi = tuple(d * 2.54 for d in density)
+        elif marker == 0xee and segment[:5] == b'Adobe':
+            adobe = True
+        elif marker in SOF_MARKERS:
+            height, width, components = struct.unpack('>HHB', segment[1:6])
+            return (width, height), components, adobe, dpi
+        offset += 2 + length
+    raise NotJpeg()
+
+
+# Everything add_page needs to know about page image. Images can be prepared
+# in parallel, and then added to the document in order.
+PageImage = namedtuple('PageImage', ['size', 'dpi', 'colorspace', 'jpeg',
+                                     'decode'])
+
+
+def encode_image(filename):
+    '''
+    Decode image and compress it as JPEG.
+    '''
+    with Image.open(filename) as image:
+        dpi = image.info.get('dpi', (DEFAULT_DPI, DEFAULT_DPI))
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        data = BytesIO()
+        image.save(data, 'JPEG', quality=JPEG_QUALITY)
+        colorspace = '/DeviceGray' if image.mode == 'L' else '/DeviceRGB'
+        return PageImage(image.size, dpi, colorspace, data.getvalue(), None)
+
+
+def read_jpeg(filename):
+    '''
+    Read JPEG file as it is. Files that are not JPEG are encoded with
+    encode_image.
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    try:
+        size, components, adobe, dpi = read_jpeg_info(data)
+    except NotJpeg:
+        return encode_image(filename)
+    if components not in COLORSPACES:
+        return encode_image(filename)
+
+    # Adobe applications write CMYK JPEGs inverted
+    decode = '[1 0 1 0 1 0 1 0]' if components == 4 and adobe else None
+    return PageImage(size, dpi, COLORSPACES[components], data, decode)
+
+
+class PdfWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.tmp_name = filename + '.tmp'
+        self.file = open(self.tmp_name, 'wb')
+        self.offsets = {}
+        self.pages = []
+        self.next_id = PAGES + 1
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.unlink(self.tmp_name)
+
+    def reserve(self):
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def write_object(self, id, body, stream=None):
+        self.offsets[id] = self.file.tell()
+        self.file.write('{} 0 obj\n'.format(id).encode())
+        self.file.write(body.encode())
+        if stream is not None:
+            self.file.write(b'\nstream\n')
+            self.file.write(stream)
+            self.file.write(b'\nendstream')
+        self.file.write(b'\nendobj\n')
+
+    def add_image(self, filename):
+        '''
+        Add page with a single image that covers the whole page. The image is
+        decoded and compressed again as JPEG.
+        '''
+        self.add_page(*encode_image(filename))
+
+    def add_jpeg(self, filename):
+        '''
+        Add page with a JPEG image copied into the document without
+        re-encoding. Files that are not JPEG are added with add_image.
+        '''
+        self.add_page(*read_jpeg(filename))
+
+    def add_page(self, size, dpi, colorspace, jpeg, decode=None):
+        width, height = size
+        page_width = width * 72.0 / (dpi[0] or DEFAULT_DPI)
+        page_height = height * 72.0 / (dpi[1] or DEFAULT_DPI)
+
+        image_id, content_id, page_id = (self.reserve(), self.reserve(),
+                                         self.reserve())
+        self.write_object(image_id, (
+            '<< /Type /XObject /Subtype /Image /Width {} /Height {} '
+            '/ColorSpace {} /BitsPerComponent 8 /Filter /DCTDecode {}'
+            '/Length {} >>').format(
+                width, height, colorspace,
+                '/Decode {} '.format(decode) if decode else '', len(jpeg)),
+            jpeg)
+
+        content = 'q {:.4f} 0 0 {:.4f} 0 0 cm /Im0 Do Q'.format(
+            page_width, page_height).encode()
+        self.write_object(content_id, '<< /Length {} >>'.format(len(content)),
+                          content)
+
+        self.write_object(page_id, (
+            '<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {:.4f} {:.4f}] '
+            '/Resources << /XObject << /Im0 {} 0 R >> >> '
+            '/Contents {} 0 R >>').format(
+                PAGES, page_width, page_height, image_id, content_id))
+        self.pages.append(page_id)
+        return page_id
+
+    def write_page_tree(self):
+        kids = ' '.join('{} 0 R'.format(id) for id in self.pages)
+        self.write_object(PAGES, '<< /Type /Pages /Kids [{}] /Count {} >>'
+                          .format(kids, len(self.pages)))
+
+    def close(self):
+        self.write_page_tree()
+        self.write_object(CATALOG, '<< /Type /Catalog /Pages {} 0 R >>'
+                          .format(PAGES))
+
+        xref = self.file.tell()
+        self.file.write('xref\n0 {}\n'.format(self.next_id).encode())
+        self.file.write(b'0000000000 65535 f \n')
+        for id in range(1, self.next_id):
+            self.file.write('{:010d} 00000 n \n'.format(self.offsets[id])
+                            .encode())
+        self.file.write(('trailer\n<< /Size {} /Root {} 0 R >>\n'
+                         'startxref\n{}\n%%EOF\n')
+                        .format(self.next_id, CATALOG, xref).encode())
+        self.file.close()
+        os.replace(self.tmp_name, self.filename)
+
+
+def read_trailer(filename):
+    '''
+    Return /Size and cross-reference offset of the last trailer of a PDF
+    written by PdfWriter.
+    '''
+    with open(filename, 'rb') as f:
+        f.seek(max(0, os.path.getsize(filename) - TRAILER_WINDOW))
+        tail = f.read()
+    sizes = re.findall(rb'/Size (\d+)', tail)
+    xrefs = re.findall(rb'startxref\s+(\d+)\s+%%EOF', tail)
+    if not sizes or not xrefs:
+        raise ValueError('No trailer in {}'.format(filename))
+    return int(sizes[-1]), int(xrefs[-1])
+
+
+class PdfUpdater(PdfWriter):
+    '''
+    Add pages to a document written by PdfWriter (or updated by PdfUpdater)
+    with an incremental update. kids are object ids of the pages already in
+    the document, in order; set pages before closing to put new pages
+    between them. length is the size of the document after its last
+    update, anything after it is left from an interrupted update and is cut
+    off.
+    '''
+    def __init__(self, filename, kids, length):
+        self.filename = filename
+        self.length = length
+        self.file = open(filename, 'r+b')
+        self.file.truncate(length)
+        self.file.seek(length)
+        self.next_id, self.prev = read_trailer(filename)
+        self.offsets = {}
+        self.pages = list(kids)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.truncate(self.length)
+            self.file.close()
+
+    def close(self):
+        self.write_page_tree()
+
+        # One subsection per run of consecutive object ids
+        xref = self.file.tell()
+        self.file.write(b'xref\n')
+        ids = sorted(self.offsets)
+        while ids:
+            run = 1
+            while run < len(ids) and ids[run] == ids[0] + run:
+                run += 1
+            self.file.write('{} {}\n'.format(ids[0], run).encode())
+            for id in ids[:run]:
+                self.file.write('{:010d} 00000 n \n'.format(self.offsets[id])
+                                .encode())
+            ids = ids[run:]
+        self.file.write(('trailer\n<< /Size {} /Root {} 0 R /Prev {} >>\n'
+                         'startxref\n{}\n%%EOF\n')
+                        .format(self.next_id, CATALOG, self.prev, xref)
+                        .encode())
+        self.length = self.file.tell()
+        self.file.close()
+
+
+def write_pdf(filename, images, progress=None, embed_jpeg=False):
+    '''
+    Write images into PDF file, one image per page, in the given order.
+    If embed_jpeg is set, JPEG images are copied without re-encoding.
+    '''
+    with PdfWriter(filename) as writer:
+        for i, image in enumerate(images):
+            if progress:
+                progress(i, image)
+            if embed_jpeg:
+                writer.add_jpeg(image)
+            else:
+                writer.add_image(image)
+
+
+def main():
+    parser = argparse.ArgumentParser('Write images into a PDF file')
+    parser.add_argument('output', help='Output PDF file')
+    parser.add_argument('images', nargs='+', help='Page images, in order')
+    parser.add_argument('--embed-jpeg', action='store_true',
+                        help='Copy JPEG images without re-encoding')
+    args = parser.parse_args()
+
+    def progress(i, image):
+        print('Adding {0}/{1} | {2}'.format(i + 1, len(args.images), image))
+
+    write_pdf(args.output, args.images, progress, args.embed_jpeg)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+'''
+Staged producer/consumer pipeline.
+
+Items flow through a list of stages connected by bounded queues. Every stage
+runs its own number of worker threads, so different items can be in
+different stages at the same time: while one page is being downloaded, the
+previous one is stitched and the one before it is written out. A stage can be
+ordered, then it gets items in the order they were fed into the pipeline
+(it must have a single worker).
+'''
+
+import heapq
+import queue
+import sys
+import threading
+import time
+
+from manuscript_dl.metrics import metrics
+
+# Marks the end of input of a stage
+DONE = object()
+
+
+class Stage:
+    def __init__(self, name, function, workers=1, ordered=False):
+        if ordered and workers != 1:
+            raise ValueError('Ordered stage {} must have one worker'
+                             .format(name))
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.ordered = ordered
+        self.count = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def record(self, started, finished):
+        with self.lock:
+            if self.started is None:
+                self.started = started
+            self.finished = finished
+            self.count += 1
+            self.busy += finished - started
+            return self.count, self.rate()
+
+    def rate(self):
+        if self.started is None or self.finished <= self.started:
+            return 0.0
+        return self.count / (self.finished - self.started)
+
+    def summary(self):
+        return '{}: {} items, {:.2f} items/s, busy {:.1f}s on {} workers'.format(
+            self.name, self.count, self.rate(), self.busy, self.workers)
+
+
+def print_line(line):
+    # A single write, so that lines from different workers do not mix
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def run_pipeline(stages, items, queue_size=2, report=print_line):
+    '''
+    Pass every item through all stages, the result of one stage is the input
+    of the next one. Return when all items are through. If a stage fails, the
+    rest of the items are dropped and the first error is raised.
+    '''
+    items = list(items)
+    queues = [queue.Queue(queue_size) for _ in stages]
+    failed = []
+
+    def forward(i, index, item):
+        if i + 1 < len(queues):
+            queues[i + 1].put((index, item))
+
+    def process(i, stage, index, item):
+        if failed:
+            return
+        started, cpu_started = time.time(), time.thread_time()
+        try:
+            result = stage.function(item)
+        except BaseException as e:
+            failed.append(e)
+            return
+        finished = time.time()
+        metrics.observe('stage.' + stage.name, finished - started,
+                        cpu=time.thread_time() - cpu_started,
+                        item=str(items[index]))
+        count, rate = stage.record(started, finished)
+        report('{} {} ({}/{}, {:.2f}/s)'.format(
+            stage.name, items[index], count, len(items), rate))
+        forward(i, index, result)
+
+    def worker(i, stage, remaining):
+        pending, expected = [], 0
+        while True:
+            index, item = queues[i].get()
+            if item is DONE:
+                break
+            if not stage.ordered:
+                process(i, stage, index, item)
+                continue
+            heapq.heappush(pending, (index, item))
+            while pending and pending[0][0] == expected:
+                _, item = heapq.heappop(pending)
+                process(i, stage, expected, item)
+                expected += 1
+
+        # Let other workers of this stage see the end too, the last one to
+        # finish passes it on
+        queues[i].put((None, DONE))
+        with remaining['lock']:
+            remaining['workers'] -= 1
+            last = remaining['workers'] == 0
+        if last:
+            forward(i, None, DONE)
+
+    threads = []
+    for i, stage in enumerate(stages):
+        remaining = {'workers': stage.workers, 'lock': threading.Lock()}
+        for _ in range(stage.workers):
+            thread = threading.Thread(target=worker, args=(i, stage, remaining),
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    for index, item in enumerate(items):
+        if failed:
+            break
+        queues[0].put((index, item))
+    queues[0].put((None, DONE))
+
+    for thread in threads:
+        thread.join()
+
+    for stage in stages:
+        report(stage.summary())
+    if failed:
+        raise failed[0]
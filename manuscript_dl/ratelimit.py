@@ -0,0 +1,127 @@
+'''
+Per-host rate governor shared by all download workers.
+
+Each host gets a concurrency limit that is adjusted with additive increase /
+multiplicative decrease: every healthy response raises the limit by 1/limit
+(about one more request in flight per round trip), while 429 or 503 halves it
+and pauses all requests to that host for Retry-After seconds, or for an
+exponential backoff if the server did not say how long to wait.
+'''
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from manuscript_dl.metrics import metrics
+
+THROTTLE_STATUSES = (429, 503)
+MAX_THROTTLE_RETRIES = 8
+MAX_BACKOFF = 120
+
+
+def parse_retry_after(value):
+    '''
+    Retry-After is either a number of seconds or an HTTP date.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostGovernor:
+    def __init__(self, maximum, minimum=1, initial=4):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.throttled = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self.condition.wait(wait if wait > 0 else None)
+
+    def release(self, status=None, retry_after=None):
+        '''
+        Report how the request went. status is None if it failed without
+        a response, which leaves the limit as it is.
+        '''
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status in THROTTLE_STATUSES:
+                # Responses to requests that were already in flight when the
+                # host paused us do not count as another signal
+                if now >= self.paused_until:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.throttled += 1
+                    delay = parse_retry_after(retry_after)
+                    if delay is None:
+                        delay = random.uniform(
+                            1, min(MAX_BACKOFF, 2 ** self.throttled))
+                    self.paused_until = now + delay
+            elif status is not None:
+                self.throttled = 0
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RateGovernor:
+    def __init__(self, maximum=4):
+        self.maximum = maximum
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, url):
+        name = urlsplit(url).netloc.lower()
+        with self.lock:
+            if name not in self.hosts:
+                self.hosts[name] = HostGovernor(self.maximum)
+            return self.hosts[name]
+
+    def get(self, session, url, **kwargs):
+        '''
+        Do session.get(url) within the host limit. Throttled requests are
+        repeated once the host lets us in again; the last response is returned
+        if it is still throttled after MAX_THROTTLE_RETRIES attempts.
+        '''
+        governor = self.host(url)
+        host = urlsplit(url).netloc.lower()
+        for attempt in range(MAX_THROTTLE_RETRIES):
+            if attempt:
+                metrics.count('http.retry', host=host)
+            governor.acquire()
+            response = None
+            started = time.time()
+            try:
+                response = session.get(url, **kwargs)
+            finally:
+                if response is None:
+                    governor.release()
+                    metrics.count('http.error', host=host, url=url)
+                else:
+                    governor.release(response.status_code,
+                                     response.headers.get('Retry-After'))
+            metrics.observe('http', time.time() - started,
+                            len(response.content), url=url,
+                            status=response.status_code)
+            if response.status_code not in THROTTLE_STATUSES:
+                break
+            metrics.count('http.throttled', host=host,
+                          status=response.status_code)
+        return response
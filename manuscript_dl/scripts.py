@@ -0,0 +1,25 @@
+'''
+Access to the downloader scripts from other programs. The scripts have dots
+in their names (bl.uk.py), so they cannot be imported, they are loaded by
+path instead.
+'''
+
+import importlib.util
+from os.path import abspath, dirname, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+_loaded = {}
+
+
+def load_script(filename):
+    '''
+    Load script from the repository root once and return it as a module.
+    '''
+    if filename not in _loaded:
+        name = filename.replace('.', '_').replace('-', '_')
+        spec = importlib.util.spec_from_file_location(name, join(ROOT, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _loaded[filename] = module
+    return _loaded[filename]
@@ -0,0 +1,56 @@
+'''
+Content-addressed store of tile images.
+
+Every tile is kept once, under the SHA-256 of its bytes, however many pages
+or manuscripts it appears in: blank margins and colour charts are often
+byte-identical. Which tile goes where is recorded elsewhere (e.g. in the
+journal of a manuscript), by hash.
+'''
+
+import hashlib
+import os
+import tempfile
+from os.path import exists, join
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class TileStore:
+    def __init__(self, directory, extension='jpg'):
+        self.directory = directory
+        self.extension = extension
+
+    def path(self, hash):
+        return join(self.directory, hash[:2], '{}.{}'.format(hash, self.extension))
+
+    def has(self, hash):
+        return exists(self.path(hash))
+
+    def put(self, data):
+        '''
+        Store data unless it is already there and return its hash. The blob
+        is written through a temporary file of its own, so a blob on disk is
+        complete even if several threads store the same one at once. Whoever
+        renames last wins, the content is the same.
+        '''
+        hash = content_hash(data)
+        path = self.path(hash)
+        if not exists(path):
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                if exists(tmp):
+                    os.remove(tmp)
+                raise
+        return hash
+
+    def get(self, hash):
+        with open(self.path(hash), 'rb') as f:
+            return f.read()
@@ -0,0 +1,38 @@
+'''
+HTTP transport shared by the IIIF downloaders: one session with kept-alive
+connections, used by all worker threads, and a rate governor in front of it.
+'''
+
+import logging
+
+import requests
+
+from manuscript_dl.ratelimit import RateGovernor
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
+
+_session = requests.Session()
+_governor = RateGovernor()
+
+def configure_pool(hosts, size, max_in_flight):
+    # pool_block makes workers wait for a free connection instead of opening
+    # extra ones that would be thrown away
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=hosts, pool_maxsize=size, pool_block=True)
+    _session.mount('https://', adapter)
+    _session.mount('http://', adapter)
+    _governor.maximum = max_in_flight
+
+def http_get_sync(url, headers=None):
+    req_headers = {'User-Agent': USER_AGENT, 'Accept': '*/*'}
+    if headers:
+        req_headers.update(headers)
+    logging.info('sync HTTP GET %s', url)
+    try:
+        resp = _governor.get(_session, url, headers=req_headers)
+        resp.raise_for_status()
+        return resp.content
+    except requests.HTTPError as e:
+        logging.error('ERROR HTTP GET %s %s', url, e)
+        return None
+        #raise
@@ -0,0 +1,219 @@
+'''
+Work queue shared by worker processes through a SQLite file.
+
+Tasks are (kind, key) pairs, e.g. ('download', 'f001r'). A worker leases a
+task for a while, does it and marks it done, adding the tasks that follow
+from it in the same transaction. If a worker dies, its lease runs out and
+the task is handed to another worker. Barrier tasks are only leased once
+every other task is done, e.g. writing the PDF after all pages are encoded.
+
+Workers can run on several hosts as long as the queue is on a file system
+with working locks. The queue therefore keeps SQLite's default rollback
+journal, WAL only works on a single host.
+'''
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL DEFAULT '',
+    barrier INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'ready',
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (kind, key)
+)
+'''
+MAX_ATTEMPTS = 3
+# How long to wait for other workers before looking for a task again
+POLL_INTERVAL = 2.0
+
+Task = namedtuple('Task', ['kind', 'key', 'payload'])
+
+
+def worker_name():
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                             threading.get_ident())
+
+
+class WorkQueue:
+    def __init__(self, filename, lease_time=600):
+        self.filename = filename
+        self.lease_time = lease_time
+        # Commits are done by hand, BEGIN IMMEDIATE takes the write lock
+        # before a task is picked, so two workers never pick the same one
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute(SCHEMA)
+
+    def transaction(self, statements):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self.db)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def add(self, tasks, barrier=False):
+        '''
+        Add (kind, key, payload) tasks that are not queued yet.
+        '''
+        self.transaction(lambda db: db.executemany(
+            'INSERT OR IGNORE INTO tasks (kind, key, payload, barrier) '
+            'VALUES (?, ?, ?, ?)',
+            [(kind, key, payload, int(barrier))
+             for kind, key, payload in tasks]))
+
+    def lease(self, owner):
+        '''
+        Take the next task that is ready or whose lease has run out. Return
+        None if there is nothing to do right now.
+        '''
+        def pick(db):
+            now = time.time()
+            available = ("(state = 'ready' OR "
+                         "(state = 'leased' AND lease_until < ?))")
+            row = db.execute(
+                'SELECT kind, key, payload FROM tasks WHERE barrier = 0 AND '
+                + available + ' ORDER BY rowid LIMIT 1', (now,)).fetchone()
+            if row is None:
+                unfinished, = db.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE barrier = 0 AND "
+                    "state IN ('ready', 'leased')").fetchone()
+                if unfinished:
+                    return None
+                row = db.execute(
+                    'SELECT kind, key, payload FROM tasks WHERE barrier = 1 '
+                    'AND ' + available + ' ORDER BY rowid LIMIT 1',
+                    (now,)).fetchone()
+                if row is None:
+                    return None
+            db.execute(
+                "UPDATE tasks SET state = 'leased', owner = ?, "
+                'lease_until = ?, attempts = attempts + 1 '
+                'WHERE kind = ? AND key = ?',
+                (owner, now + self.lease_time, row[0], row[1]))
+            return Task(*row)
+        return self.transaction(pick)
+
+    def renew(self, task, owner):
+        self.transaction(lambda db: db.execute(
+            'UPDATE tasks SET lease_until = ? '
+            "WHERE kind = ? AND key = ? AND owner = ? AND state = 'leased'",
+            (time.time() + self.lease_time, task.kind, task.key, owner)))
+
+    def complete(self, task, owner, result=None, follow=()):
+        '''
+        Mark task done and queue the tasks that follow from it, given as
+        (kind, key, payload) triples. A worker that has lost its lease still
+        completes the task, the work is the same whoever does it.
+        '''
+        def done(db):
+            db.execute(
+                "UPDATE tasks SET state = 'done', owner = ?, result = ? "
+                'WHERE kind = ? AND key = ?',
+                (owner, result, task.kind, task.key))
+            db.executemany(
+                'INSERT OR IGNORE INTO tasks (kind, key, payload) '
+                'VALUES (?, ?, ?)', follow)
+        self.transaction(done)
+
+    def fail(self, task, owner, error):
+        '''
+        Put task back into the queue, or give up on it after MAX_ATTEMPTS.
+        '''
+        self.transaction(lambda db: db.execute(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? "
+            "THEN 'failed' ELSE 'ready' END, owner = ?, error = ? "
+            'WHERE kind = ? AND key = ?',
+            (MAX_ATTEMPTS, owner, error, task.kind, task.key)))
+
+    def retry(self, barriers=()):
+        '''
+        Give failed tasks another MAX_ATTEMPTS, e.g. when the queue is filled
+        again by a new run. Finished barrier tasks given as (kind, key) pairs
+        are done again too, their input may have changed.
+        '''
+        def reset(db):
+            db.execute("UPDATE tasks SET state = 'ready', attempts = 0, "
+                       "error = NULL WHERE state = 'failed'")
+            db.executemany("UPDATE tasks SET state = 'ready', attempts = 0 "
+                           "WHERE kind = ? AND key = ? AND state = 'done'",
+                           barriers)
+        self.transaction(reset)
+
+    def query(self, sql, parameters=()):
+        # Lease renewal shares the connection, statements must not interleave
+        with self.lock:
+            return self.db.execute(sql, parameters).fetchall()
+
+    def result(self, kind, key):
+        rows = self.query(
+            'SELECT result FROM tasks WHERE kind = ? AND key = ?', (kind, key))
+        return rows[0][0] if rows else None
+
+    def counts(self):
+        '''
+        Number of tasks of every kind in every state.
+        '''
+        counts = {}
+        for kind, state, count in self.query(
+                'SELECT kind, state, COUNT(*) FROM tasks GROUP BY kind, state'):
+            counts.setdefault(kind, {})[state] = count
+        return counts
+
+    def pending(self):
+        return self.query(
+            "SELECT COUNT(*) FROM tasks WHERE state IN ('ready', 'leased')"
+        )[0][0]
+
+    def close(self):
+        self.db.close()
+
+
+def run_worker(queue, handlers, owner=None, report=print):
+    '''
+    Do tasks until the queue has no unfinished ones left. handlers map task
+    kind to a function that takes the task and returns (result, follow).
+    The lease is renewed while a task runs.
+    '''
+    owner = owner or worker_name()
+    while True:
+        task = queue.lease(owner)
+        if task is None:
+            if not queue.pending():
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        finished = threading.Event()
+
+        def keep_lease():
+            while not finished.wait(queue.lease_time / 3.0):
+                queue.renew(task, owner)
+        renewer = threading.Thread(target=keep_lease, daemon=True)
+        renewer.start()
+        try:
+            result, follow = handlers[task.kind](task)
+        except Exception as e:
+            report('{} {} failed: {!r}'.format(task.kind, task.key, e))
+            queue.fail(task, owner, repr(e))
+        else:
+            queue.complete(task, owner, result, follow)
+        finally:
+            finished.set()
+            renewer.join()
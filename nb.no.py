@@ -1,31 +1,27 @@
 #!/usr/bin/env python3
 
-import re
 import argparse
 import logging
 import logging.handlers
-from collections import namedtuple
-from io import BytesIO
-from json import dumps, loads
-from multiprocessing.pool import ThreadPool
-from os import makedirs
-from os.path import dirname, exists, join
+from json import loads
+from os.path import exists, join
 from shutil import which
 from tempfile import gettempdir
-from textwrap import dedent
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError
 
-from diskcache import Cache
-from PIL import Image
 from plumbum import local, FG
 
-USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
+from manuscript_dl import iiif
+from manuscript_dl.cache import HttpCache
+from manuscript_dl.iiif import fs_friendly
+from manuscript_dl.metrics import metrics
+from manuscript_dl.ocr import CACHE_DIR as OCR_CACHE_DIR, ocr_pages
+from manuscript_dl.transport import configure_pool, http_get_sync
+
 FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.DEBUG)
 
-bash = local['bash']
-cache = Cache(join(gettempdir(), 'manuscript-dl', 'nb.no'))
+URL_MANIFEST = 'https://api.nb.no/catalog/v1/iiif/{}/manifest?profile=nbdigital'
+CACHE_DIR = join(gettempdir(), 'manuscript-dl', 'nb.no')
 
 def must_bin(name):
     where = which(name)
@@ -33,162 +29,123 @@ def must_bin(name):
         raise Exception('Missing {}'.format(name))
     return where
 
-@cache.memoize()
-def http_get_sync(url, headers=None):
-    req = Request(url)
-    req.add_header('User-Agent', USER_AGENT)
-    req.add_header('Accept', '*/*')
-    if headers:
-        for k, v in headers.items():
-            req.add_header(k, v)
-    logging.info('sync HTTP GET %s', url)
-    try:
-        with urlopen(req) as resp:
-            return resp.read()
-    except HTTPError as e:
-        logging.error('ERROR HTTP GET %s %s', url, e)
-        return None
-        #raise
-
 def suffix(s, suffix):
     if s.endswith(suffix): return s
     return s + suffix
 
 def get_manifest(id, downloader):
     # https://api.nb.no/catalog/v1/iiif/URN:NBN:no-nb_digibok_2008091504048/manifest?profile=nbdigital
-    url = 'https://api.nb.no/catalog/v1/iiif/{}/manifest?profile=nbdigital'.format(id)
+    url = URL_MANIFEST.format(id)
     data = downloader(url)
     return loads(data)
 
-Shape = namedtuple('Shape', ['width', 'height'])
-Tile = namedtuple('Tile', ['width', 'scale'])
-Page = namedtuple('Page', ['id', 'url', 'index', 'shape', 'tile'])
-
-def ensure_dir(filename):
-    dir = dirname(filename)
-    if not exists(dir):
-        makedirs(dir)
-    return filename
-
-def spit(data, filename):
-    with open(ensure_dir(filename), 'w') as f:
-        f.write(data)
-
-def fs_friendly(path):
-    # return re.sub(r'[^a-zA-Z0-9_\-\.]', '_', path)
-    return path.replace('/', '_').replace(':', '_')
-
-class Book:
+class Book(iiif.Book):
     #  https://www.nb.no/services/image/resolver/URN:NBN:no-nb_digibok_2008091504048_0025/0,0,1024,1024/1024,/0/default.jpg
-    def __init__(self, id: str, downloader):
-        self.downloader = downloader
+    def __init__(self, id: str, downloader, scale=0.5, page_workers=1,
+                 tile_workers=4, memory_budget=1024 * 1024 * 1024, dzi=False,
+                 manifest=None):
+        manifest = manifest or get_manifest(id, downloader)
+        dir = join('nb.no', fs_friendly(id) + '-' + fs_friendly(manifest['label']))
+        super().__init__(manifest, downloader, dir, tiled=True, scale=scale,
+                         page_workers=page_workers, tile_workers=tile_workers,
+                         memory_budget=memory_budget, dzi=dzi)
         self.id = id
-        self.manifest = get_manifest(id, downloader)
-        self.label = fs_friendly(self.manifest['label'])
-        self.dir = join('nb.no', fs_friendly(id) + '-' + self.label)
-
-    def get_page(self, page: Page):
-        filename = join(self.dir, '{:04d}_{}.png'.format(page.index, page.id))
-        if exists(filename): return
-        cx, cy = 0, 0
-        img = Image.new('RGB', (page.shape.width, page.shape.height))
-        while cy < page.shape.height:
-            #tw, th = page.tile.width, page.tile.height
-            while cx < page.shape.width:
-                tile_url = page.url + '/{},{},{},{}/{},/0/default.jpg'.format(
-                    cx, cy, page.tile.width, page.tile.height, page.tile.width)
-                data = self.downloader(tile_url)
-                if data is not None:
-                    tile = Image.open(BytesIO(data))
-                    #tw, th = tile.size
-                    #print('TILE size', tile.size)
-                    img.paste(tile, (cx, cy))
-                cx += page.tile.width
-                #cx += tw
-            cx = 0
-            cy += page.tile.height
-            #cy += th
-        img.save(ensure_dir(filename))
-        logging.info('saved %s', filename)
 
-    def download(self):
-        spit(dumps(self.manifest, indent=4), join(self.dir, 'manifest.json'))
-
-        tasks = []
-        index = 0
-        for sequence in self.manifest['sequences']:
-            for canvas in sequence['canvases']:
-                for image in canvas['images']:
-                    service = image['resource']['service']
-                    url = service['@id']
-                    id = url.split('_')[-1]
-                    #size = max(service['sizes'], key=lambda x: x['width'])
-                    #tile_shape = Shape(size['width'], size['height'])
-                    #tile_shape = Shape(2048, 2048)
-                    tile_shape = Shape(1024, 1024)
-                    #tile_shape = Shape(512, 512)
-                    page_shape = Shape(service['width'], service['height'])
-                    page = Page(id, url, index, page_shape, tile_shape)
-                    # self.get_page(page)
-                    tasks.append(page)
-                    index += 1
-
-        with ThreadPool(1) as pool:
-            for _ in pool.imap(self.get_page, tasks): pass
-
-    def convert(self, filename):
+    def page_id(self, url):
+        return url.split('_')[-1]
+
+    def convert(self, filename, language='nor', jobs=6,
+                cache_dir=OCR_CACHE_DIR):
+        '''
+        OCR every page on its own, in jobs processes, and join the page PDFs
+        into the book. Pages that have been recognised before are taken
+        from the cache.
+        '''
         filename = suffix(filename or self.label, '.pdf')
-        #cmd = 'convert -density 300 -quality 100 {}/????_*.png {}'.format(self.dir, filename)
-        script = f'''
-        #!/bin/bash
-        set -e
-        set -x
-        mkdir -p pdf
-        mkdir -p out
-        #parallel --bar convert "{{}}" "pdf/{{.}}.pdf" ::: *.png
-        #parallel --jobs 1 --bar convert -resize "50%" "{{}}" "pdf/{{.}}.pdf" ::: *.png
-        parallel --jobs 6 --bar gm convert -resize "50%" "{{}}" "pdf/{{.}}.pdf" ::: *.png
-        pdftk pdf/*.pdf cat output out/out.pdf
-        ocrmypdf -l nor --jobs 6 --output-type pdfa out/out.pdf "../../{filename}"
-'''
-        script = dedent(script).strip()
-        spit(script, join(self.dir, 'convert.sh'))
-        with local.cwd(self.dir):
-            bash['./convert.sh'] & FG
-
-        # print(f'cd "{self.dir}"')
-        # print('parallel --bar convert "{}" "{.}.pdf" ::: *.png')
-        # # print('pdfunite *.pdf out.pdf')
-        # print('pdftk *.pdf cat output out.pdf')
-        # #print('convert -density 300 -quality 100 *.png out.pdf')
-        # print(f'ocrmypdf -l nor --jobs 12 --output-type pdfa out.pdf "{filename}"')
+        images = []
+        for page in self.pages():
+            image = self.page_filename(page)
+            if exists(image):
+                images.append(image)
+            else:
+                logging.error('missing page %s', image)
+
+        def progress(i, image, cached, duration):
+            metrics.observe('ocr', duration, cached=cached, page=image)
+            logging.info('ocr %d/%d %s%s', i + 1, len(images), image,
+                         ' (cached)' if cached else '')
+
+        pages = ocr_pages(images, language, cache_dir, jobs, progress)
+        with metrics.timed('join'):
+            local['pdftk'][pages + ['cat', 'output', filename]] & FG
+        logging.info('saved %s', filename)
 
 def main():
-    must_bin('bash')
-    must_bin('convert')
-    must_bin('pdftk')
-    must_bin('ocrmypdf')
-    must_bin('parallel')
-    must_bin('gm')
-
     # python ./nb.no.py -H 'header: value' URN:NBN:no-nb_digibok_2008091504048
     parser = argparse.ArgumentParser('Download books from nb.no')
     parser.add_argument('id', help='Book ID')
     parser.add_argument('filename', nargs='?', default=None, help='Output filename')
     parser.add_argument('-H', '--header', help='HTTP header', action='append')
+    parser.add_argument('--scale', type=float, default=0.5,
+                        help='Scale of pages to request from the server')
+    parser.add_argument('--page-workers', type=int, default=2,
+                        help='Number of pages to download at the same time')
+    parser.add_argument('--tile-workers', type=int, default=8,
+                        help='Number of tiles to download at the same time, across all pages')
+    parser.add_argument('--memory-budget', type=int, default=1024,
+                        help='Memory for page images in flight, MiB')
+    parser.add_argument('--pool-hosts', type=int, default=4,
+                        help='Number of hosts to keep connection pools for')
+    parser.add_argument('--pool-size', type=int, default=16,
+                        help='Number of kept-alive connections per host')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help='HTTP cache directory')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='Size limit of cached tiles, MiB')
+    parser.add_argument('--manifest-ttl', type=int, default=24,
+                        help='How long to keep cached manifests, hours')
+    parser.add_argument('--ocr-language', default='nor',
+                        help='Tesseract language of the book')
+    parser.add_argument('--ocr-jobs', type=int, default=6,
+                        help='Number of pages to OCR at the same time')
+    parser.add_argument('--ocr-cache-dir', default=OCR_CACHE_DIR,
+                        help='OCR results cache directory')
+    parser.add_argument('--trace', default=None,
+                        help='Append every request and stage to this JSON-lines file')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port')
+    parser.add_argument('--dzi', action='store_true',
+                        help='Write every page as a Deep Zoom image, no PDF')
     args = parser.parse_args()
     print(args)
+    if not args.dzi:
+        must_bin('pdftk')
+        must_bin('tesseract')
+    configure_pool(args.pool_hosts, args.pool_size, args.tile_workers)
+    if args.trace:
+        metrics.open_trace(args.trace)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    cache = HttpCache(args.cache_dir, args.cache_size * 1024 * 1024,
+                      args.manifest_ttl * 3600)
 
     def downloader(url):
         headers = {}
-        for h in args.header:
+        for h in args.header or []:
             k, v = h.split(':', 1)
             headers[k.strip()] = v.strip()
-        return http_get_sync(url, headers)
+        return cache.get(url, lambda url: http_get_sync(url, headers))
 
-    book = Book(args.id, downloader)
+    book = Book(args.id, downloader, args.scale, args.page_workers,
+                args.tile_workers, args.memory_budget * 1024 * 1024, args.dzi)
     book.download()
-    book.convert(args.filename)
+    logging.info('cache: %s', cache.summary())
+    if not args.dzi:
+        book.convert(args.filename, args.ocr_language, args.ocr_jobs,
+                     args.ocr_cache_dir)
+    for line in metrics.summary():
+        logging.info('metrics: %s', line)
+    metrics.close()
 
 if __name__ == '__main__':
     main()